@@ -1,13 +1,15 @@
-from flask import Flask, request, jsonify, send_from_directory, make_response
+from flask import Flask, Request, request, jsonify, send_from_directory, make_response, Response, stream_with_context, g, has_app_context
 from flask_cors import CORS
 import os
 from werkzeug.utils import secure_filename
-from PIL import Image
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge, UnsupportedMediaType
+from PIL import Image, ImageOps, features
 import torch
 from transformers import CLIPProcessor, CLIPModel
 import sqlite3
 import time
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 import jwt
 import datetime
 from functools import wraps
@@ -16,7 +18,27 @@ import bcrypt
 from dotenv import load_dotenv
 import base64
 from io import BytesIO
+import zipfile
+import tempfile
+import shutil
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+import numpy as np
+import hashlib
+import threading
+import uuid
+import random
+import ast
+import re
+import html
+import queue
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+try:
+    import faiss  # Optional: approximate nearest-neighbour index for large catalogs
+except ImportError:
+    faiss = None
 
 # Load environment variables
 load_dotenv()
@@ -26,15 +48,33 @@ CORS(app, supports_credentials=True, origins="*")
 
 # Configuration
 UPLOAD_FOLDER = 'uploads'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp', 'tiff', 'svg'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp', 'tiff', 'tif'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 # Ensure upload folder exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Lazy loading for CLIP model
+# CLIP model loading: 'lazy' loads on the first request, 'eager' warms up in the background at startup
+CLIP_MODEL_NAME = os.getenv('CLIP_MODEL_NAME', "openai/clip-vit-base-patch32")
+CLIP_LOAD_MODE = os.getenv('CLIP_LOAD_MODE', 'lazy')
 _model = None
 _processor = None
+_model_lock = threading.Lock()
+
+# CPU inference profile: intra-op threads per worker (0 keeps torch's default) and
+# optional dynamic int8 quantization of the linear layers ('none' or 'int8')
+CLIP_NUM_THREADS = int(os.getenv('CLIP_NUM_THREADS', '0'))
+CLIP_QUANTIZE = os.getenv('CLIP_QUANTIZE', 'none')
+
+# Warm-up state reported by /api/health: cold -> warming -> ready (or failed)
+_clip_state = 'cold'
+_clip_warmup_seconds = None
+_clip_warmup_error = None
+
+# Precomputed prompt embeddings, persisted so restarts skip text encoding
+PROMPT_BANK_DIR = os.getenv('PROMPT_BANK_DIR', 'prompt_banks')
+_prompt_banks = {}
+_prompt_bank_lock = threading.Lock()
 
 # JWT config
 app.config['SECRET_KEY'] = 'your-secret-key-here'  # In production, use environment variable
@@ -42,11 +82,70 @@ app.config['JWT_EXPIRATION_DELTA'] = datetime.timedelta(days=1)
 
 # Google Gemini Configuration
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', '')
+GEMINI_BACKEND = os.getenv('GEMINI_BACKEND', 'google')  # 'fake' answers locally without an API key
+GEMINI_MODELS = [name.strip() for name in os.getenv('GEMINI_MODELS', 'gemini-1.5-flash,gemini-1.5-pro').split(',') if name.strip()]
+GEMINI_MODEL_TTL = float(os.getenv('GEMINI_MODEL_TTL', '3600'))  # seconds before the resolved model is checked again
+# Resilience around Gemini calls: concurrency cap, per-call deadline, jittered retries and a circuit breaker
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '4'))
+GEMINI_DEADLINE_SECONDS = float(os.getenv('GEMINI_DEADLINE_SECONDS', '15'))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '2'))
+GEMINI_RETRY_BASE_SECONDS = float(os.getenv('GEMINI_RETRY_BASE_SECONDS', '0.5'))
+GEMINI_BREAKER_THRESHOLD = int(os.getenv('GEMINI_BREAKER_THRESHOLD', '5'))  # consecutive failures that open the circuit
+GEMINI_BREAKER_RESET_SECONDS = float(os.getenv('GEMINI_BREAKER_RESET_SECONDS', '30'))
+# Images sent to Gemini Vision are downscaled and re-encoded in memory first
+GEMINI_IMAGE_MAX_SIDE = int(os.getenv('GEMINI_IMAGE_MAX_SIDE', '768'))
+GEMINI_IMAGE_QUALITY = int(os.getenv('GEMINI_IMAGE_QUALITY', '85'))
+GEMINI_IMAGE_CACHE_SIZE = int(os.getenv('GEMINI_IMAGE_CACHE_SIZE', '256'))
+# Fake backend fault injection, for exercising the above locally
+GEMINI_FAKE_LATENCY_MS = float(os.getenv('GEMINI_FAKE_LATENCY_MS', '0'))
+GEMINI_FAKE_ERROR_RATE = float(os.getenv('GEMINI_FAKE_ERROR_RATE', '0'))
+
+# Database: pooled connections with WAL and tuned pragmas
+DATABASE = os.getenv('DATABASE_PATH', 'products.db')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))  # 0 disables pooling
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '5'))
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',  # readers no longer block behind the upload writer
+    'PRAGMA synchronous = NORMAL',  # fsync at checkpoints only; safe with WAL
+    'PRAGMA cache_size = -32000',  # 32 MB page cache per connection
+    'PRAGMA mmap_size = 268435456',  # 256 MB of memory-mapped reads
+    'PRAGMA temp_store = MEMORY',
+)
+_db_pool = queue.LifoQueue(maxsize=max(DB_POOL_SIZE, 1))
+
+def connect_db():
+    """Open a tuned SQLite connection; routes should use get_db() instead."""
+    conn = sqlite3.connect(DATABASE, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def get_db():
+    """Return the connection of the current app context, taken from the pool when possible."""
+    if 'db' not in g:
+        try:
+            g.db = _db_pool.get_nowait()
+        except queue.Empty:
+            g.db = connect_db()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    """Return the context's connection to the pool, rolling back anything left uncommitted."""
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    try:
+        conn.rollback()
+        if DB_POOL_SIZE <= 0:
+            raise queue.Full
+        _db_pool.put_nowait(conn)
+    except (queue.Full, sqlite3.Error):
+        conn.close()
 
 # Database setup
-def init_db():
-    """Initialize the SQLite database and create tables if they do not exist."""
-    conn = sqlite3.connect('products.db')
+def create_base_tables(conn):
+    """Migration 1: the tables init_db used to create with CREATE TABLE IF NOT EXISTS."""
     c = conn.cursor()
     c.execute('''
         CREATE TABLE IF NOT EXISTS users
@@ -70,22 +169,533 @@ def init_db():
          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
          user_id INTEGER)
     ''')
-    conn.commit()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS product_categories
+        (product_id TEXT NOT NULL,
+         category_path TEXT NOT NULL,
+         confidence REAL,
+         PRIMARY KEY (product_id, category_path))
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_product_categories_path
+        ON product_categories (category_path, product_id)
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS product_embeddings
+        (product_id TEXT PRIMARY KEY,
+         model_version TEXT NOT NULL,
+         dim INTEGER NOT NULL,
+         embedding BLOB NOT NULL,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+    ''')
+
+def add_product_hot_path_indexes(conn):
+    """Migration 3: composite indexes for the product listing queries (see check_query_plans)."""
+    c = conn.cursor()
+    # /api/products: WHERE user_id = ? ORDER BY created_at DESC
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_user_created ON products (user_id, created_at)')
+    # /api/all-products: ORDER BY created_at DESC, id DESC (id is not the rowid, so it has to be in the index)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_created ON products (created_at, id)')
+    # /api/all-products?sort=price_asc|price_desc
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_price ON products (price, id)')
+    # users.email already has the implicit UNIQUE index used by login and register
+    c.execute('ANALYZE')
+
+def category_paths_sql(column):
+    """SQL expression joining the category paths stored as JSON in `column` into one searchable string."""
+    return f'''(CASE WHEN json_valid({column}) THEN (
+        SELECT group_concat(CASE type WHEN 'object' THEN json_extract(value, '$.name') WHEN 'text' THEN value END, ' ; ')
+        FROM json_each({column})
+    ) END)'''
+
+def add_product_search_index(conn):
+    """Migration 4: FTS5 index over product name, description and category paths, kept in sync by triggers."""
+    c = conn.cursor()
+    # products_fts.rowid mirrors products.rowid; prefix indexes keep "phon*" style queries fast
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, description, categories,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts (rowid, name, description, categories)
+            VALUES (new.rowid, new.name, new.description, {category_paths_sql('new.categories')});
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, description, categories ON products BEGIN
+            DELETE FROM products_fts WHERE rowid = old.rowid;
+            INSERT INTO products_fts (rowid, name, description, categories)
+            VALUES (new.rowid, new.name, new.description, {category_paths_sql('new.categories')});
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+            DELETE FROM products_fts WHERE rowid = old.rowid;
+        END
+    ''')
+    rebuild_search_index(conn)
+
+def rebuild_search_index(conn):
+    """Re-fill products_fts from products (e.g. after a VACUUM, which may renumber rowids); the caller commits."""
+    c = conn.cursor()
+    c.execute('DELETE FROM products_fts')
+    c.execute(f'''
+        INSERT INTO products_fts (rowid, name, description, categories)
+        SELECT rowid, name, description, {category_paths_sql('categories')} FROM products
+    ''')
+    c.execute("INSERT INTO products_fts (products_fts) VALUES ('optimize')")
+
+def add_catalog_version(conn):
+    """Migration 5: a catalog version counter that every product write (and seller rename) bumps."""
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_version
+        (id INTEGER PRIMARY KEY CHECK (id = 1),
+         version INTEGER NOT NULL)
+    ''')
+    c.execute('INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 1)')
+    for name, event in (('insert', 'INSERT'), ('update', 'UPDATE'), ('delete', 'DELETE')):
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS catalog_version_product_{name} AFTER {event} ON products BEGIN
+                UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+            END
+        ''')
+    # Catalog listings include the seller's name
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS catalog_version_seller_update AFTER UPDATE OF name_surname, email ON users BEGIN
+            UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+        END
+    ''')
+
+def add_product_image_variants(conn):
+    """Migration 6: products.image_variants holds the resized copies of the product image as JSON."""
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(products)')]
+    if 'image_variants' not in columns:
+        conn.execute('ALTER TABLE products ADD COLUMN image_variants TEXT')
+
+# Content-addressed upload storage: uploads/ab/cd/<sha256>.<ext>, shared by every product with the same image
+def blob_relative_path(digest, extension):
+    return f"{digest[:2]}/{digest[2:4]}/{digest}{extension}"
+
+def variant_filename(filename, width, extension):
+    return f"{os.path.splitext(filename)[0]}_w{width}.{extension}"
+
+def upload_path(image_url):
+    """Filesystem path of an /uploads/ URL, or None for external or unsafe URLs."""
+    if not image_url or not image_url.startswith('/uploads/'):
+        return None
+    return safe_join(app.config['UPLOAD_FOLDER'], image_url[len('/uploads/'):])
+
+def place_upload_file(path, source_path):
+    """Put the file at source_path at path (a hard link when possible), unless path already exists."""
+    if os.path.exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source_path, temp_path)
+    except OSError:
+        shutil.copyfile(source_path, temp_path)
+    os.replace(temp_path, path)
+    return True
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def existing_blob_path(conn, digest):
+    row = conn.execute('SELECT path FROM blobs WHERE hash = ?', (digest,)).fetchone()
+    return row[0] if row else None
+
+def store_blob(cursor, digest, size, extension, source_path):
+    """Add a reference to the blob with this digest, placing source_path there if missing, and return its /uploads/ URL.
+
+    Call it inside the write transaction that stores the referencing product: the
+    refcount update takes SQLite's write lock, so a concurrent release_blob cannot
+    delete the file between the check and the commit.
+    """
+    cursor.execute('''
+        INSERT INTO blobs (hash, path, size, refcount) VALUES (?, ?, ?, 1)
+        ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1
+    ''', (digest, blob_relative_path(digest, extension), size))
+    path = cursor.execute('SELECT path FROM blobs WHERE hash = ?', (digest,)).fetchone()[0]
+    place_upload_file(os.path.join(app.config['UPLOAD_FOLDER'], path), source_path)
+    return f"/uploads/{path}"
+
+def retain_blob(cursor, image_url):
+    """Add a reference for a product that points at an existing upload by URL.
+
+    Returns False for an /uploads/ URL that is not a stored blob (a variant, or a
+    file no blob row owns): such a product could later delete files it does not own.
+    Other URLs (external images) need no reference.
+    """
+    if not image_url or not image_url.startswith('/uploads/'):
+        return True
+    cursor.execute('UPDATE blobs SET refcount = refcount + 1 WHERE path = ?', (image_url[len('/uploads/'):],))
+    return cursor.rowcount == 1
+
+def remove_blob_files(blob_path):
+    """Delete a blob's file and every resized variant written next to it."""
+    path = os.path.join(app.config['UPLOAD_FOLDER'], blob_path)
+    directory, stem = os.path.split(os.path.splitext(path)[0])
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name == os.path.basename(path) or name.startswith(f"{stem}_w"):
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+def release_blob(cursor, image_url):
+    """Drop a product's reference to its image; returns the blob path when that was the last reference.
+
+    Like store_blob, call it inside the write transaction that deletes the product,
+    then pass the returned path to remove_released_blob once that has committed.
+    Files without a blob row are never removed.
+    """
+    if not image_url or not image_url.startswith('/uploads/'):
+        return None
+    row = cursor.execute('SELECT hash, refcount, path FROM blobs WHERE path = ?', (image_url[len('/uploads/'):],)).fetchone()
+    if not row:
+        return None
+    if row[1] > 1:
+        cursor.execute('UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?', (row[0],))
+        return None
+    cursor.execute('DELETE FROM blobs WHERE hash = ?', (row[0],))
+    return row[2]
+
+def remove_released_blob(conn, blob_path):
+    """Delete the files of a blob released by a committed transaction, unless an upload has stored it again since.
+
+    The check runs under SQLite's write lock, which store_blob also holds while it
+    places the file, so a new upload of the same image cannot lose its file.
+    """
+    if not blob_path:
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if not conn.execute('SELECT 1 FROM blobs WHERE path = ?', (blob_path,)).fetchone():
+            remove_blob_files(blob_path)
+    finally:
+        conn.commit()
+
+def migrate_uploads_to_blobs(conn):
+    """Migration 7: blob table, and flat uploads/<millis>_<name> files moved into content-addressed storage.
+
+    Files are linked into place first; the flat originals are returned as a cleanup
+    step that run_migrations calls once the rows pointing at the new paths are committed.
+    """
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS blobs
+        (hash TEXT PRIMARY KEY,
+         path TEXT NOT NULL UNIQUE,
+         size INTEGER NOT NULL,
+         refcount INTEGER NOT NULL,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+    ''')
+
+    # Several products may share one flat file: every one of them is a reference to its blob
+    products_by_url = {}
+    for product_id, image_url, variants_json in c.execute('''
+        SELECT id, image_url, image_variants FROM products
+        WHERE image_url LIKE '/uploads/%' AND image_url NOT LIKE '/uploads/%/%'
+    ''').fetchall():
+        products_by_url.setdefault(image_url, []).append((product_id, variants_json))
+
+    old_paths = set()
+    moved = 0
+    for image_url, products in products_by_url.items():
+        old_path = upload_path(image_url)
+        if not old_path or not os.path.isfile(old_path):
+            continue
+        digest = file_sha256(old_path)
+        size = os.path.getsize(old_path)
+        extension = os.path.splitext(old_path)[1].lower()
+        for product_id, variants_json in products:
+            new_url = store_blob(c, digest, size, extension, old_path)
+
+            # Variants follow the blob's name; a duplicate image may already have them
+            variants = json.loads(variants_json) if variants_json else None
+            for variant in variants or []:
+                for key, url in list(variant.items()):
+                    if key == 'width':
+                        continue
+                    new_variant_url = variant_filename(new_url, variant['width'], key)
+                    old_variant_path = upload_path(url)
+                    if old_variant_path and os.path.isfile(old_variant_path):
+                        place_upload_file(upload_path(new_variant_url), old_variant_path)
+                        old_paths.add(old_variant_path)
+                    variant[key] = new_variant_url
+
+            c.execute(
+                'UPDATE products SET image_url = ?, image_variants = ? WHERE id = ?',
+                (new_url, json.dumps(variants) if variants is not None else None, product_id)
+            )
+            moved += 1
+        old_paths.add(old_path)
+    if moved:
+        print(f"Moved uploads of {moved} products into content-addressed storage")
+
+    def remove_flat_files():
+        for path in old_paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return remove_flat_files
+
+def parse_categories_column(value):
+    """Parse products.categories, which holds JSON or (from older POSTs) a Python literal."""
+    if not value:
+        return []
+    if not isinstance(value, str):
+        return value
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        pass
+    try:
+        parsed = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return []
+    return parsed if isinstance(parsed, list) else []
+
+def normalize_category_entries(categories):
+    """Turn [{'name': ..., 'confidence': ...}] or ['path', ...] into {category_path: confidence}."""
+    entries = {}
+    for category in categories or []:
+        if isinstance(category, dict):
+            path = category.get('name')
+            confidence = category.get('confidence')
+        else:
+            path = category
+            confidence = None
+        if not isinstance(path, str) or not path.strip():
+            continue
+        path = path.strip()
+        if path not in entries or (confidence is not None and (entries[path] is None or confidence > entries[path])):
+            entries[path] = float(confidence) if confidence is not None else None
+    return entries
+
+def save_product_categories(cursor, product_id, categories):
+    """Replace a product's rows in product_categories."""
+    cursor.execute('DELETE FROM product_categories WHERE product_id = ?', (product_id,))
+    cursor.executemany(
+        'INSERT INTO product_categories (product_id, category_path, confidence) VALUES (?, ?, ?)',
+        [(product_id, path, confidence) for path, confidence in normalize_category_entries(categories).items()]
+    )
+
+def migrate_product_categories(conn):
+    """Backfill product_categories from products.categories and rewrite Python-literal values as JSON."""
+    c = conn.cursor()
+    c.execute('''
+        SELECT id, categories FROM products
+        WHERE NOT EXISTS (SELECT 1 FROM product_categories pc WHERE pc.product_id = products.id)
+    ''')
+    migrated = 0
+    for product_id, raw_categories in c.fetchall():
+        categories = parse_categories_column(raw_categories)
+        if not categories:
+            continue
+        if isinstance(raw_categories, str):
+            try:
+                json.loads(raw_categories)
+            except json.JSONDecodeError:
+                c.execute('UPDATE products SET categories = ? WHERE id = ?', (json.dumps(categories), product_id))
+        save_product_categories(c, product_id, categories)
+        migrated += 1
+    if migrated:
+        print(f"Migrated categories of {migrated} products into product_categories")
+
+def add_embedding_deletion_log(conn):
+    """Migration 8: log of deleted product embeddings, so every worker's vector index can drop them."""
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS product_embedding_deletions
+        (id INTEGER PRIMARY KEY,
+         product_id TEXT NOT NULL,
+         embedding_rowid INTEGER NOT NULL,
+         deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+    ''')
+    # INSERT OR REPLACE does not fire this (recursive_triggers is off), so re-embedding is not a deletion
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS product_embeddings_delete AFTER DELETE ON product_embeddings BEGIN
+            INSERT INTO product_embedding_deletions (product_id, embedding_rowid) VALUES (old.product_id, old.rowid);
+        END
+    ''')
+
+def add_embedding_autoincrement(conn):
+    """Migration 9: rebuild product_embeddings with an AUTOINCREMENT key so rowids are never reused.
+
+    ProductVectorIndex.sync only reads rows above the highest rowid it has seen;
+    without AUTOINCREMENT a deleted or replaced last row would hand its rowid to
+    the next insert, which sync would then miss.
+    """
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE product_embeddings_new
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         product_id TEXT NOT NULL UNIQUE,
+         model_version TEXT NOT NULL,
+         dim INTEGER NOT NULL,
+         embedding BLOB NOT NULL,
+         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+    ''')
+    c.execute('''
+        INSERT INTO product_embeddings_new (id, product_id, model_version, dim, embedding, created_at)
+        SELECT rowid, product_id, model_version, dim, embedding, created_at FROM product_embeddings ORDER BY rowid
+    ''')
+    # Dropping the table drops its trigger without firing it
+    c.execute('DROP TABLE product_embeddings')
+    c.execute('ALTER TABLE product_embeddings_new RENAME TO product_embeddings')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS product_embeddings_delete AFTER DELETE ON product_embeddings BEGIN
+            INSERT INTO product_embedding_deletions (product_id, embedding_rowid) VALUES (old.product_id, old.rowid);
+        END
+    ''')
+
+def add_seller_listing_indexes(conn):
+    """Migration 10: seller indexes that end in id, so seller pages sort and seek on the index."""
+    c = conn.cursor()
+    # /api/all-products?seller=: ORDER BY created_at DESC, id DESC and its keyset cursor
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_user_created_id ON products (user_id, created_at, id)')
+    # /api/all-products?seller=&sort=price_asc|price_desc
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_user_price ON products (user_id, price, id)')
+    # Replaced by idx_products_user_created_id, which also serves /api/products
+    c.execute('DROP INDEX IF EXISTS idx_products_user_created')
+    c.execute('ANALYZE')
+
+def add_jobs_table(conn):
+    """Migration 11: description job state shared by every worker (see SQLiteJobQueue)."""
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS jobs
+        (id TEXT PRIMARY KEY,
+         kind TEXT NOT NULL,
+         owner TEXT NOT NULL,
+         status TEXT NOT NULL,
+         result TEXT,
+         error TEXT,
+         created_at REAL NOT NULL,
+         started_at REAL,
+         finished_at REAL)
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at)')
+
+# Schema migrations run in order at startup; append new ones, never edit applied ones.
+# run_migrations applies them inside one write transaction, so they must not call commit().
+MIGRATIONS = [
+    (1, 'create_base_tables', create_base_tables),
+    (2, 'backfill_product_categories', migrate_product_categories),
+    (3, 'add_product_hot_path_indexes', add_product_hot_path_indexes),
+    (4, 'add_product_search_index', add_product_search_index),
+    (5, 'add_catalog_version', add_catalog_version),
+    (6, 'add_product_image_variants', add_product_image_variants),
+    (7, 'migrate_uploads_to_blobs', migrate_uploads_to_blobs),
+    (8, 'add_embedding_deletion_log', add_embedding_deletion_log),
+    (9, 'add_embedding_autoincrement', add_embedding_autoincrement),
+    (10, 'add_seller_listing_indexes', add_seller_listing_indexes),
+    (11, 'add_jobs_table', add_jobs_table),
+]
+
+def schema_version(conn):
+    """Return the highest applied migration version (0 for a database without migrations)."""
+    row = conn.execute('SELECT MAX(version) FROM schema_migrations').fetchone()
+    return row[0] or 0
+
+def run_migrations(conn):
+    """Apply every migration newer than the database's recorded schema version.
+
+    The version check and all pending migrations run in one BEGIN IMMEDIATE
+    transaction, so when several workers start at once the first one migrates and
+    the others wait for the write lock, then see the new version and do nothing.
+    Migrations must therefore not commit themselves; one that has to touch files
+    outside the database can return a cleanup function, called after the commit.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations
+            (version INTEGER PRIMARY KEY,
+             name TEXT NOT NULL,
+             applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)
+        ''')
+        current = schema_version(conn)
+        applied = []
+        cleanups = []
+        for version, name, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            cleanup = migrate(conn)
+            if cleanup:
+                cleanups.append(cleanup)
+            conn.execute('INSERT INTO schema_migrations (version, name) VALUES (?, ?)', (version, name))
+            applied.append((version, name))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    for version, name in applied:
+        print(f"Applied schema migration {version}: {name}")
+    for cleanup in cleanups:
+        cleanup()
+
+# How long a starting worker waits for another one to finish migrating
+MIGRATION_LOCK_TIMEOUT = 600
+
+def init_db():
+    """Initialize the SQLite database and bring its schema up to date."""
+    conn = connect_db()
+    conn.execute(f'PRAGMA busy_timeout = {MIGRATION_LOCK_TIMEOUT * 1000}')
+    run_migrations(conn)
     conn.close()
 
 # Create the database when the app starts
 init_db()
 
+def apply_inference_profile(model, quantize=None):
+    """Put a CLIP model in eval mode and optionally quantize its linear layers to int8."""
+    quantize = CLIP_QUANTIZE if quantize is None else quantize
+    model.eval()
+    if quantize == 'int8':
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif quantize != 'none':
+        raise ValueError(f"Unknown CLIP_QUANTIZE value: {quantize}")
+    return model
+
+def load_clip():
+    """Load the CLIP model and processor exactly once, even under concurrent first requests."""
+    global _model, _processor
+    if _model is not None and _processor is not None:
+        return _model, _processor
+    with _model_lock:
+        if _model is None:
+            if CLIP_NUM_THREADS > 0:
+                torch.set_num_threads(CLIP_NUM_THREADS)
+            _model = apply_inference_profile(CLIPModel.from_pretrained(CLIP_MODEL_NAME))
+        if _processor is None:
+            _processor = CLIPProcessor.from_pretrained(CLIP_MODEL_NAME)
+    return _model, _processor
+
 def get_model():
-    global _model
     if _model is None:
-        _model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
+        load_clip()
     return _model
 
 def get_processor():
-    global _processor
     if _processor is None:
-        _processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
+        load_clip()
     return _processor
 
 # Ana kategoriler ve alt kategoriler
@@ -242,8 +852,17 @@ def flatten_categories(hierarchy, parent_category=""):
             else:  # Nested category
                 nested = flatten_categories(data, full_category)
                 flattened.extend(nested)
+        elif isinstance(data, list):  # Item list inside a nested category
+            for item in data:
+                flattened.append((parent_category, category, item))
     return flattened
 
+# Extra prompt templates used for every leaf item, next to its main category's own prompt
+LEAF_PROMPT_TEMPLATES = [
+    "a clear product photo of {}",
+    "this is a {} product photo",
+]
+
 def generate_prompts(category_data):
     """Generates dynamic prompts for each category."""
     prompts = []
@@ -261,14 +880,267 @@ def generate_prompts(category_data):
         # Main prompt
         prompts.append(prompt_template.format(item))
         categories.append(f"{category_path} - {item}")
-        # Specific prompt
-        prompts.append(f"a clear product photo of {item}")
-        categories.append(f"{category_path} - {item}")
-        # English prompt
-        prompts.append(f"this is a {item} product photo")
-        categories.append(f"{category_path} - {item}")
+        # Specific and English prompts
+        for template in LEAF_PROMPT_TEMPLATES:
+            prompts.append(template.format(item))
+            categories.append(f"{category_path} - {item}")
     return prompts, categories
 
+# Prompt templates for the main-category classifier
+MAIN_CATEGORY_PROMPT_TEMPLATES = [
+    "a product photo of {} item",
+    "this is a {} product",
+]
+
+def build_main_category_prompts():
+    """Build (prompts, labels) for every top-level category in PRODUCT_HIERARCHY."""
+    prompts = []
+    labels = []
+    for category in PRODUCT_HIERARCHY:
+        for template in MAIN_CATEGORY_PROMPT_TEMPLATES:
+            prompts.append(template.format(category.lower()))
+            labels.append(category)
+    return prompts, labels
+
+# Prompt banks: name -> (prompt builder, templates that shape its prompts)
+def build_leaf_prompts():
+    """Build (prompts, labels) for every leaf item, labelled with its full category path."""
+    return generate_prompts(PRODUCT_HIERARCHY)
+
+PROMPT_BANKS = {
+    'main': (build_main_category_prompts, MAIN_CATEGORY_PROMPT_TEMPLATES),
+    'leaf': (build_leaf_prompts, LEAF_PROMPT_TEMPLATES),
+}
+
+def hierarchy_hash():
+    """Return a stable hash of PRODUCT_HIERARCHY so banks rebuild when it changes."""
+    encoded = json.dumps(PRODUCT_HIERARCHY, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+def prompt_bank_version(name='main'):
+    """Version key of a prompt bank: model name, hierarchy hash and prompt templates."""
+    _, templates = PROMPT_BANKS[name]
+    key = json.dumps({
+        'bank': name,
+        'model': CLIP_MODEL_NAME,
+        'quantize': CLIP_QUANTIZE,
+        'hierarchy': hierarchy_hash(),
+        'templates': templates
+    }, sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+def encode_text_prompts(prompts, model=None):
+    """Encode prompts with the CLIP text tower and return L2-normalized embeddings."""
+    model = model or get_model()
+    processor = get_processor()
+    with torch.inference_mode():
+        text_inputs = processor(text=prompts, return_tensors="pt", padding=True)
+        text_features = model.get_text_features(**text_inputs)
+        return torch.nn.functional.normalize(text_features, dim=-1)
+
+def build_prompt_bank(name, version):
+    """Encode every prompt of a bank and group the embeddings by label."""
+    builder, _ = PROMPT_BANKS[name]
+    prompts, labels = builder()
+    embeddings = encode_text_prompts(prompts)
+
+    # Averaging normalized prompt embeddings keeps a label's score equal to the
+    # mean cosine similarity over its prompts, with a single matmul per image
+    categories = list(dict.fromkeys(labels))
+    label_embeddings = torch.stack([
+        embeddings[[i for i, label in enumerate(labels) if label == category]].mean(dim=0)
+        for category in categories
+    ])
+
+    # Row indices of each top-level category, used to score only part of a bank
+    groups = {}
+    for i, category in enumerate(categories):
+        groups.setdefault(category.split(' - ')[0], []).append(i)
+
+    return {
+        'name': name,
+        'version': version,
+        'prompts': prompts,
+        'labels': labels,
+        'embeddings': embeddings,
+        'categories': categories,
+        'category_embeddings': label_embeddings,
+        'groups': groups
+    }
+
+def get_prompt_bank(name='main'):
+    """Return the prompt bank from memory, the local bank file, or a fresh build."""
+    version = prompt_bank_version(name)
+    bank = _prompt_banks.get(name)
+    if bank is not None and bank['version'] == version:
+        return bank
+
+    with _prompt_bank_lock:
+        bank = _prompt_banks.get(name)
+        if bank is not None and bank['version'] == version:
+            return bank
+
+        bank_path = os.path.join(PROMPT_BANK_DIR, f"{name}_{version}.pt")
+        bank = None
+        if os.path.exists(bank_path):
+            try:
+                bank = torch.load(bank_path, map_location='cpu')
+                if bank.get('version') != version:
+                    bank = None
+            except Exception as e:
+                print(f"Could not read prompt bank {bank_path}: {str(e)}")
+                bank = None
+
+        if bank is None:
+            print(f"Building prompt bank '{name}' (version {version})")
+            bank = build_prompt_bank(name, version)
+            try:
+                os.makedirs(PROMPT_BANK_DIR, exist_ok=True)
+                temp_path = f"{bank_path}.tmp"
+                torch.save(bank, temp_path)
+                os.replace(temp_path, bank_path)
+            except Exception as e:
+                print(f"Could not save prompt bank {bank_path}: {str(e)}")
+
+        _prompt_banks[name] = bank
+        return bank
+
+# Decoding limits: inputs above MAX_IMAGE_PIXELS are rejected before any pixel is decoded
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', str(40 * 1000 * 1000)))
+# Pillow warns above this and raises DecompressionBombError above twice this on every Image.open
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+CLIP_INPUT_SIZE = 224
+
+class ImageTooLargeError(ValueError):
+    """Raised when an image's declared dimensions exceed MAX_IMAGE_PIXELS."""
+
+def decode_image(stream, min_size=CLIP_INPUT_SIZE):
+    """Decode an image from a file-like object in memory, at no more resolution than CLIP needs.
+
+    JPEGs use draft mode to decode at 1/2, 1/4 or 1/8 scale, and other formats are
+    box-reduced, always keeping the shorter side at least `min_size` pixels.
+    """
+    image = Image.open(stream)
+    width, height = image.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ImageTooLargeError(f"Image is {width}x{height}, limit is {MAX_IMAGE_PIXELS} pixels")
+
+    if min_size:
+        image.draft('RGB', (min_size, min_size))
+    image = image.convert('RGB')
+
+    if min_size:
+        factor = min(image.size) // min_size
+        if factor >= 2:
+            image = image.reduce(factor)
+    return image
+
+def encode_images(images, model=None):
+    """Encode a list of PIL images in one CLIP forward pass and return L2-normalized embeddings."""
+    model = model or get_model()
+    processor = get_processor()
+    with torch.inference_mode():
+        inputs = processor(images=images, return_tensors="pt")
+        image_features = model.get_image_features(**inputs)
+        return torch.nn.functional.normalize(image_features, dim=-1)
+
+def rank_categories(category_scores):
+    """Turn {category: score} into the sorted, thresholded suggestion list returned to clients."""
+    # Get top scoring categories with threshold
+    threshold = 0.22  # Biraz yüksek threshold
+    results = []
+
+    # Sort by similarity score
+    sorted_categories = sorted(category_scores.items(), key=lambda x: x[1], reverse=True)
+
+    for category, score in sorted_categories:
+        if score > threshold:
+            results.append({
+                'name': category,
+                'confidence': float(score)
+            })
+
+    # If no results above threshold, take top 3-4
+    if not results:
+        for category, score in sorted_categories[:4]:
+            results.append({
+                'name': category,
+                'confidence': float(score)
+            })
+    else:
+        # Maksimum 5 kategori göster
+        results = results[:5]
+
+    return results
+
+# Classifier mode: 'main' scores top-level categories only, 'leaf' scores every leaf item,
+# 'hierarchical' scores main categories first and then only the leaves under the best ones
+CLIP_CLASSIFIER_MODE = os.getenv('CLIP_CLASSIFIER_MODE', 'hierarchical')
+HIERARCHICAL_TOP_K = int(os.getenv('HIERARCHICAL_TOP_K', '3'))
+
+def score_image_features(image_features, mode=None):
+    """Score normalized image embeddings and return one {category: score} dict per image."""
+    mode = mode or CLIP_CLASSIFIER_MODE
+    if mode == 'main':
+        bank = get_prompt_bank('main')
+        similarity = image_features @ bank['category_embeddings'].T
+        return [dict(zip(bank['categories'], row.tolist())) for row in similarity]
+
+    if mode == 'leaf':
+        bank = get_prompt_bank('leaf')
+        similarity = image_features @ bank['category_embeddings'].T
+        return [dict(zip(bank['categories'], row.tolist())) for row in similarity]
+
+    if mode != 'hierarchical':
+        raise ValueError(f"Unknown classifier mode: {mode}")
+
+    # Coarse stage: main categories; fine stage: only the leaves under the top-k of them
+    main_bank = get_prompt_bank('main')
+    leaf_bank = get_prompt_bank('leaf')
+    main_similarity = image_features @ main_bank['category_embeddings'].T
+    top_main = main_similarity.topk(min(HIERARCHICAL_TOP_K, main_similarity.shape[1]), dim=1).indices
+
+    scores = []
+    for features, main_indices in zip(image_features, top_main):
+        rows = []
+        for main_index in main_indices.tolist():
+            rows.extend(leaf_bank['groups'].get(main_bank['categories'][main_index], []))
+        leaf_similarity = leaf_bank['category_embeddings'][rows] @ features
+        scores.append({leaf_bank['categories'][row]: score for row, score in zip(rows, leaf_similarity.tolist())})
+    return scores
+
+def classify_images_with_embeddings(images, mode=None):
+    """Categorize a batch of PIL images; returns (suggestions, image embedding) per image."""
+    image_features = encode_images(images)
+    with torch.inference_mode():
+        scores = score_image_features(image_features, mode)
+    return [
+        (rank_categories(category_scores), features)
+        for category_scores, features in zip(scores, image_features)
+    ]
+
+def classify_images(images, mode=None):
+    """Categorize a batch of PIL images; returns one suggestion list per image."""
+    return [categories for categories, _ in classify_images_with_embeddings(images, mode)]
+
+def categorization_version():
+    """Version of everything that shapes a categorization result: model, prompt banks and mode."""
+    banks = ['main'] if CLIP_CLASSIFIER_MODE == 'main' else ['leaf'] if CLIP_CLASSIFIER_MODE == 'leaf' else ['main', 'leaf']
+    key = json.dumps({
+        'banks': [prompt_bank_version(name) for name in banks],
+        'mode': CLIP_CLASSIFIER_MODE,
+        'top_k': HIERARCHICAL_TOP_K
+    }, sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+def embedding_to_blob(embedding):
+    """Serialize an image embedding as compact float16 bytes."""
+    return embedding.detach().to(torch.float16).cpu().numpy().tobytes()
+
+def blob_to_embedding(blob):
+    """Restore an embedding serialized by embedding_to_blob as a float32 tensor."""
+    return torch.frombuffer(bytearray(blob), dtype=torch.float16).float()
+
 def analyze_image(image_path):
     """Analyze image with CLIP model and return category suggestions with confidence scores."""
     try:
@@ -277,169 +1149,895 @@ def analyze_image(image_path):
             print(f"Image file not found: {image_path}")
             return []
 
-        image = Image.open(image_path).convert('RGB')
+        with open(image_path, 'rb') as f:
+            image = decode_image(f)
         print(f"Image loaded successfully: {image.size}")
 
-        # Get model and processor (lazy loading)
+        # Get model, processor and prompt bank (lazy loading)
         try:
-            model = get_model()
-            processor = get_processor()
-            print("CLIP model and processor loaded successfully")
+            load_clip()
         except Exception as e:
             print(f"Error loading CLIP model: {str(e)}")
             return []
 
-        # Sadece ana kategorileri kullan (daha az kategori için)
-        main_categories = list(PRODUCT_HIERARCHY.keys())
-        
-        # Basit prompts oluştur
-        prompts = []
-        for category in main_categories:
-            prompts.append(f"a product photo of {category.lower()} item")
-            prompts.append(f"this is a {category.lower()} product")
-        
-        print(f"Generated {len(prompts)} prompts for {len(main_categories)} main categories")
+        results = classify_images([image])[0]
+        print(f"Analysis completed, found {len(results)} categories")
+        return results
 
-        # Extract image features
-        inputs = processor(images=image, return_tensors="pt")
-        image_features = model.get_image_features(**inputs)
+    except Exception as e:
+        print(f"Error in analyze_image: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return []
 
-        # Extract text features for all prompts
-        text_inputs = processor(text=prompts, return_tensors="pt", padding=True)
-        text_features = model.get_text_features(**text_inputs)
+class InferenceBatcher:
+    """Coalesces concurrent single-image requests into batched CLIP forward passes.
 
-        # Calculate similarities
-        similarity = torch.cosine_similarity(image_features, text_features)
+    Callers submit one item and get a Future back. A single worker thread takes the
+    first queued item, keeps collecting for up to `window_ms` (or until `max_batch_size`
+    items), runs `handler` once on the whole batch and resolves each caller's Future.
+    Requests that arrive while a batch is running are picked up by the next batch.
+    """
 
-        # Group by main category (her ana kategori için 2 prompt var)
-        category_scores = {}
-        for i, category in enumerate(main_categories):
-            # Her kategori için 2 prompt olduğundan ortalama al
-            score1 = float(similarity[i * 2])
-            score2 = float(similarity[i * 2 + 1])
-            category_scores[category] = (score1 + score2) / 2
+    def __init__(self, handler, window_ms=5, max_batch_size=16):
+        self.handler = handler
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._batch_sizes = {}
+        self._total_queue_wait = 0.0
+        self._max_queue_wait = 0.0
+        self._total_inference = 0.0
 
-        # Get top scoring categories with threshold
-        threshold = 0.22  # Biraz yüksek threshold
-        results = []
-        
-        # Sort by similarity score
-        sorted_categories = sorted(category_scores.items(), key=lambda x: x[1], reverse=True)
+    def submit(self, item):
+        """Queue an item for the next batch and return a Future for its result."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future, time.time()))
+        return future
 
-        for category, score in sorted_categories:
-            if score > threshold:
-                results.append({
-                    'name': category,
-                    'confidence': float(score)
-                })
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='clip-batcher', daemon=True)
+                self._thread.start()
 
-        # If no results above threshold, take top 3-4
-        if not results:
-            for category, score in sorted_categories[:4]:
-                results.append({
-                    'name': category,
-                    'confidence': float(score)
-                })
-        else:
-            # Maksimum 5 kategori göster
-            results = results[:5]
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.time()
+                try:
+                    if remaining > 0:
+                        batch.append(self._queue.get(timeout=remaining))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._process(batch)
 
-        print(f"Analysis completed, found {len(results)} categories")
-        return results
+    def _process(self, batch):
+        started = time.time()
+        waits = [started - queued_at for _, _, queued_at in batch]
+        try:
+            results = self.handler([item for item, _, _ in batch])
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+        finished = time.time()
 
-    except Exception as e:
-        print(f"Error in analyze_image: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return []
+        with self._metrics_lock:
+            self._batches += 1
+            self._items += len(batch)
+            self._batch_sizes[len(batch)] = self._batch_sizes.get(len(batch), 0) + 1
+            self._total_queue_wait += sum(waits)
+            self._max_queue_wait = max(self._max_queue_wait, max(waits))
+            self._total_inference += finished - started
 
-def allowed_file(filename):
-    """Check if the file extension is allowed for upload."""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    def metrics(self):
+        """Return batch-size and queue-wait statistics since startup."""
+        with self._metrics_lock:
+            return {
+                'window_ms': self.window * 1000,
+                'max_batch_size': self.max_batch_size,
+                'queue_depth': self._queue.qsize(),
+                'batches': self._batches,
+                'images': self._items,
+                'avg_batch_size': self._items / self._batches if self._batches else 0.0,
+                'batch_size_histogram': {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                'avg_queue_wait_ms': self._total_queue_wait / self._items * 1000 if self._items else 0.0,
+                'max_queue_wait_ms': self._max_queue_wait * 1000,
+                'avg_batch_inference_ms': self._total_inference / self._batches * 1000 if self._batches else 0.0
+            }
 
-@app.route('/api/upload', methods=['POST', 'OPTIONS'])
-def upload_file():
-    """Upload a product image, analyze it, and save the product for the authenticated user."""
-    if request.method == 'OPTIONS':
-        return '', 200
-    
-    try:
-        payload = get_jwt_payload()
-        if not payload or not payload.get('user_id'):
-            return jsonify({'error': 'Authorization header missing or invalid'}), 401
-        user_id = payload['user_id']
-        
-        # Form verilerini al
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file part'}), 400
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No selected file'}), 400
-            
-        # Ürün bilgilerini al
-        name = request.form.get('name')
-        description = request.form.get('description')
-        price = request.form.get('price')
-        selected_categories = request.form.get('categories')  # JSON string olarak gelecek
-        
-        if not name or not description or not price or not selected_categories:
-            return jsonify({'error': 'Missing required product information'}), 400
-        
-        # Parse categories
-        import json
-        categories_list = json.loads(selected_categories)
-        
-        # Save the file
-        filename = secure_filename(file.filename)
-        timestamp = str(int(time.time() * 1000))
-        unique_filename = f"{timestamp}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(filepath)
-        
-        # Get user info for seller name
-        conn = sqlite3.connect('products.db')
-        c = conn.cursor()
-        
-        c.execute('SELECT name_surname, email FROM users WHERE id = ?', (user_id,))
-        user_info = c.fetchone()
-        seller_name = user_info[0] if user_info and user_info[0] else user_info[1].split('@')[0] if user_info else 'Unknown Seller'
-        
-        # Save product to database
-        product_id = timestamp
-        insert_query = '''
-            INSERT INTO products (id, name, description, image_url, categories, price, user_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        '''
+# Micro-batching for /api/categorize
+CLIP_BATCH_WINDOW_MS = float(os.getenv('CLIP_BATCH_WINDOW_MS', '5'))
+CLIP_MAX_BATCH_SIZE = int(os.getenv('CLIP_MAX_BATCH_SIZE', '16'))
+categorize_batcher = InferenceBatcher(classify_images_with_embeddings, CLIP_BATCH_WINDOW_MS, CLIP_MAX_BATCH_SIZE)
+
+# Upper bound on entries each cache keeps in its SQLite tier
+PERSISTENT_CACHE_MAX_ENTRIES = int(os.getenv('PERSISTENT_CACHE_MAX_ENTRIES', '50000'))
+
+class TieredCache:
+    """In-memory LRU cache with an optional SQLite-backed persistent tier.
+
+    Values must be JSON-serializable. Lookups check memory first, then SQLite;
+    a persistent hit is promoted back into memory. Hit and miss counters are
+    kept per tier so callers can see how much work the cache saves. The
+    persistent tier keeps at most `persistent_capacity` entries per cache,
+    dropping the oldest writes first.
+    """
+
+    PRUNE_EVERY = 64  # persistent writes between trims
+
+    def __init__(self, name, capacity=1024, db_path=None, persistent_capacity=None):
+        self.name = name
+        self.capacity = capacity
+        self.db_path = db_path
+        self.persistent_capacity = persistent_capacity or PERSISTENT_CACHE_MAX_ENTRIES
+        self._writes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._memory_hits = 0
+        self._persistent_hits = 0
+        self._misses = 0
+        if self.db_path:
+            conn = sqlite3.connect(self.db_path)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache_entries
+                (namespace TEXT NOT NULL,
+                 key TEXT NOT NULL,
+                 value TEXT NOT NULL,
+                 created_at REAL NOT NULL,
+                 PRIMARY KEY (namespace, key))
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_entries_age ON cache_entries (namespace, created_at)')
+            conn.commit()
+            conn.close()
+
+    def get(self, key):
+        """Return the cached value for key, or None."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._memory_hits += 1
+                return self._entries[key]
+
+        value = None
+        if self.db_path:
+            try:
+                conn = sqlite3.connect(self.db_path, timeout=5)
+                row = conn.execute(
+                    'SELECT value FROM cache_entries WHERE namespace = ? AND key = ?', (self.name, key)
+                ).fetchone()
+                conn.close()
+                value = json.loads(row[0]) if row else None
+            except sqlite3.Error as e:
+                print(f"Cache '{self.name}' read failed: {str(e)}")
+
+        with self._lock:
+            if value is None:
+                self._misses += 1
+                return None
+            self._persistent_hits += 1
+            self._store(key, value)
+        return value
+
+    def set(self, key, value):
+        """Store value in memory and, if configured, in the persistent tier."""
+        with self._lock:
+            self._store(key, value)
+        if self.db_path:
+            try:
+                conn = sqlite3.connect(self.db_path, timeout=5)
+                conn.execute(
+                    'INSERT OR REPLACE INTO cache_entries (namespace, key, value, created_at) VALUES (?, ?, ?, ?)',
+                    (self.name, key, json.dumps(value), time.time())
+                )
+                self._writes += 1
+                if self._writes % self.PRUNE_EVERY == 0:
+                    conn.execute('''
+                        DELETE FROM cache_entries WHERE namespace = ? AND key IN (
+                            SELECT key FROM cache_entries WHERE namespace = ?
+                            ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                        )
+                    ''', (self.name, self.name, self.persistent_capacity))
+                conn.commit()
+                conn.close()
+            except sqlite3.Error as e:
+                print(f"Cache '{self.name}' write failed: {str(e)}")
+
+    def _store(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        """Return hit/miss counters and sizes."""
+        with self._lock:
+            lookups = self._memory_hits + self._persistent_hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'capacity': self.capacity,
+                'persistent': bool(self.db_path),
+                'memory_hits': self._memory_hits,
+                'persistent_hits': self._persistent_hits,
+                'misses': self._misses,
+                'hit_rate': (self._memory_hits + self._persistent_hits) / lookups if lookups else 0.0
+            }
+
+# Categorization results keyed by image content hash and categorization version
+CATEGORIZATION_CACHE_SIZE = int(os.getenv('CATEGORIZATION_CACHE_SIZE', '2048'))
+CATEGORIZATION_CACHE_DB = os.getenv('CATEGORIZATION_CACHE_DB', '')
+categorization_cache = TieredCache('categorization', CATEGORIZATION_CACHE_SIZE, CATEGORIZATION_CACHE_DB or None)
+
+def categorization_cache_key(image_bytes):
+    """Cache key for an image: hash of its bytes plus the current categorization version."""
+    return categorization_cache_key_for_digest(hashlib.sha256(image_bytes).hexdigest())
+
+def categorization_cache_key_for_digest(digest):
+    return f"{digest}:{categorization_version()}"
+
+def cache_categorization(key, categories, embedding):
+    categorization_cache.set(key, {
+        'categories': categories,
+        'embedding': base64.b64encode(embedding_to_blob(embedding)).decode('ascii')
+    })
+
+# CLIP text embeddings of search queries, so popular queries skip the text tower
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv('QUERY_EMBEDDING_CACHE_SIZE', '4096'))
+query_embedding_cache = TieredCache('query_embeddings', QUERY_EMBEDDING_CACHE_SIZE, CATEGORIZATION_CACHE_DB or None)
+
+# Generated product descriptions, so "regenerate" clicks and reused photos skip Gemini
+DESCRIPTION_CACHE_SIZE = int(os.getenv('DESCRIPTION_CACHE_SIZE', '1024'))
+# Persistent by default: every entry saved a paid Gemini call, so keep them across restarts
+DESCRIPTION_CACHE_DB = os.getenv('DESCRIPTION_CACHE_DB', CATEGORIZATION_CACHE_DB or 'cache.db')
+description_cache = TieredCache('descriptions', DESCRIPTION_CACHE_SIZE, DESCRIPTION_CACHE_DB or None)
+# Downscaled JPEGs prepared for Gemini, by original image hash, so a regenerate can send just the hash
+gemini_image_cache = TieredCache('gemini_images', GEMINI_IMAGE_CACHE_SIZE)
+
+def image_embedding_version():
+    """Version tag stored with product embeddings: they only depend on the image model."""
+    return f"{CLIP_MODEL_NAME}:{CLIP_QUANTIZE}"
+
+def image_embedding_for_upload(stream):
+    """Return the CLIP embedding for an UploadStream, reusing the one computed during /api/categorize."""
+    cached = categorization_cache.get(categorization_cache_key_for_digest(stream.hexdigest()))
+    if cached:
+        return blob_to_embedding(base64.b64decode(cached['embedding']))
+    stream.seek(0)
+    return encode_images([decode_image(stream)])[0]
+
+def save_product_embedding(cursor, product_id, embedding):
+    """Store a product's image embedding as a float16 blob."""
+    cursor.execute('''
+        INSERT OR REPLACE INTO product_embeddings (product_id, model_version, dim, embedding)
+        VALUES (?, ?, ?, ?)
+    ''', (product_id, image_embedding_version(), int(embedding.shape[-1]), embedding_to_blob(embedding)))
+
+class ProductVectorIndex:
+    """Nearest-neighbour index over product image embeddings.
+
+    The default backend is a brute-force NumPy search: embeddings are L2-normalized
+    rows of a float32 matrix and a query is one matrix-vector product plus
+    argpartition. With VECTOR_INDEX_BACKEND=faiss (and faiss installed) an HNSW
+    index is used instead for large catalogs; removals are tombstoned until the
+    next rebuild. The index loads lazily and picks up rows written by other
+    workers through `sync`, which only reads product_embeddings rows with a
+    higher rowid than it has already seen (rowids are AUTOINCREMENT, so never
+    reused), and drops products listed in
+    product_embedding_deletions (filled by a trigger) since its last sync.
+    """
+
+    def __init__(self, backend='numpy'):
+        self.backend = 'faiss' if backend == 'faiss' and faiss is not None else 'numpy'
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._max_rowid = 0
+        self._max_deletion_id = 0
+        self._ids = []
+        self._positions = {}
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._faiss_index = None
+        self._tombstones = set()
+
+    def _reset(self, dim):
+        self._ids = []
+        self._positions = {}
+        self._matrix = np.zeros((1024, dim), dtype=np.float32)
+        self._tombstones = set()
+        if self.backend == 'faiss':
+            self._faiss_index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+
+    def sync(self):
+        """Load embeddings stored since the last sync (all of them on first use)."""
+        with self._lock:
+            owns_connection = not has_app_context()
+            conn = connect_db() if owns_connection else get_db()
+            c = conn.cursor()
+            # Deletions first, so a product deleted and re-added since the last sync ends up present
+            c.execute(
+                'SELECT id, product_id FROM product_embedding_deletions WHERE id > ? ORDER BY id',
+                (self._max_deletion_id,)
+            )
+            for deletion_id, product_id in c.fetchall():
+                self._remove(product_id)
+                self._max_deletion_id = deletion_id
+            c.execute('''
+                SELECT rowid, product_id, embedding FROM product_embeddings
+                WHERE rowid > ? AND model_version = ?
+                ORDER BY rowid
+            ''', (self._max_rowid, image_embedding_version()))
+            for rowid, product_id, blob in c.fetchall():
+                self._add(product_id, np.frombuffer(blob, dtype=np.float16).astype(np.float32))
+                self._max_rowid = max(self._max_rowid, rowid)
+            if owns_connection:
+                conn.close()
+            self._loaded = True
+
+    def _add(self, product_id, vector):
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        if not self._matrix.size:
+            self._reset(vector.shape[0])
+        if product_id in self._positions:
+            self._remove(product_id)
+
+        if len(self._ids) == self._matrix.shape[0]:
+            grown = np.zeros((self._matrix.shape[0] * 2, self._matrix.shape[1]), dtype=np.float32)
+            grown[:len(self._ids)] = self._matrix[:len(self._ids)]
+            self._matrix = grown
+        self._matrix[len(self._ids)] = vector
+        self._positions[product_id] = len(self._ids)
+        self._ids.append(product_id)
+        if self._faiss_index is not None:
+            self._faiss_index.add(vector.reshape(1, -1))
+
+    def _remove(self, product_id):
+        position = self._positions.pop(product_id, None)
+        if position is None:
+            return
+        if self._faiss_index is not None:
+            # HNSW cannot delete: keep the slot and hide it from results
+            self._tombstones.add(position)
+            return
+        # Swap the last row into the freed slot
+        last = len(self._ids) - 1
+        if position != last:
+            moved_id = self._ids[last]
+            self._matrix[position] = self._matrix[last]
+            self._ids[position] = moved_id
+            self._positions[moved_id] = position
+        self._ids.pop()
+
+    def add(self, product_id, embedding):
+        """Add or replace a product's embedding."""
+        with self._lock:
+            if not self._loaded:
+                self.sync()
+            self._add(product_id, embedding.detach().cpu().float().numpy() if torch.is_tensor(embedding) else embedding)
+
+    def remove(self, product_id):
+        """Drop a product from the index."""
+        with self._lock:
+            if self._loaded:
+                self._remove(product_id)
+
+    def get(self, product_id):
+        """Return the stored (normalized) embedding of a product, or None."""
+        self.sync()
+        with self._lock:
+            position = self._positions.get(product_id)
+            return None if position is None else self._matrix[position].copy()
+
+    def search(self, query, k=12, exclude=None):
+        """Return up to k (product_id, cosine similarity) pairs, best first."""
+        if torch.is_tensor(query):
+            query = query.detach().cpu().float().numpy()
+        query = query.astype(np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        exclude = exclude or set()
+
+        self.sync()
+        with self._lock:
+            size = len(self._ids)
+            if size == 0:
+                return []
+            wanted = min(size, k + len(exclude))
+
+            if self._faiss_index is not None:
+                scores, positions = self._faiss_index.search(query.reshape(1, -1), wanted + len(self._tombstones))
+                candidates = [(int(p), float(sc)) for p, sc in zip(positions[0], scores[0]) if p >= 0 and p not in self._tombstones]
+            else:
+                scores = self._matrix[:size] @ query
+                top = np.argpartition(-scores, wanted - 1)[:wanted] if wanted < size else np.arange(size)
+                top = top[np.argsort(-scores[top])]
+                candidates = [(int(p), float(scores[p])) for p in top]
+
+            results = []
+            for position, score in candidates:
+                product_id = self._ids[position]
+                if product_id in exclude:
+                    continue
+                results.append((product_id, score))
+                if len(results) >= k:
+                    break
+            return results
+
+# Visual similarity index over product_embeddings ('numpy' brute force or 'faiss' HNSW)
+VECTOR_INDEX_BACKEND = os.getenv('VECTOR_INDEX_BACKEND', 'numpy')
+product_vector_index = ProductVectorIndex(VECTOR_INDEX_BACKEND)
+
+def warm_up_clip():
+    """Load CLIP and the prompt bank, then run one dummy inference to set up allocators and kernels."""
+    global _clip_state, _clip_warmup_seconds, _clip_warmup_error
+    _clip_state = 'warming'
+    start = time.time()
+    try:
+        load_clip()
+        dummy = Image.new('RGB', (224, 224), color=(127, 127, 127))
+        classify_images([dummy])
+        _clip_warmup_seconds = time.time() - start
+        _clip_state = 'ready'
+        print(f"CLIP warm-up completed in {_clip_warmup_seconds:.2f}s")
+    except Exception as e:
+        _clip_warmup_error = str(e)
+        _clip_state = 'failed'
+        print(f"CLIP warm-up failed: {str(e)}")
+
+def start_clip_warmup():
+    """Warm up CLIP on a background thread so the worker can bind its port immediately."""
+    thread = threading.Thread(target=warm_up_clip, name='clip-warmup', daemon=True)
+    thread.start()
+    return thread
+
+def clip_status():
+    """Return the CLIP readiness state used by the health check."""
+    state = _clip_state
+    if state == 'cold' and _model is not None:
+        state = 'ready'
+    return {
+        'state': state,
+        'load_mode': CLIP_LOAD_MODE,
+        'model': CLIP_MODEL_NAME,
+        'quantize': CLIP_QUANTIZE,
+        'num_threads': torch.get_num_threads(),
+        'warmup_seconds': _clip_warmup_seconds,
+        'error': _clip_warmup_error
+    }
+
+def allowed_file(filename):
+    """Check if the file extension is allowed for upload."""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+# Upload limits: each image part, whole bulk requests, and the multipart overhead allowed around a single image
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', str(16 * 1024 * 1024)))
+MAX_BATCH_REQUEST_BYTES = int(os.getenv('MAX_BATCH_REQUEST_BYTES', str(512 * 1024 * 1024)))
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+# Every other request, including JSON bodies carrying a base64 image of up to MAX_UPLOAD_BYTES
+MAX_REQUEST_BYTES = int(os.getenv('MAX_REQUEST_BYTES', str(MAX_UPLOAD_BYTES * 4 // 3 + UPLOAD_FORM_OVERHEAD)))
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+# Endpoints accepting a whole bulk request of MAX_BATCH_REQUEST_BYTES
+BATCH_ENDPOINTS = {'categorize_batch'}
+# Same filesystem as the blobs, so accepted files are hard-linked into place instead of copied
+UPLOAD_TEMP_DIR = os.path.join(UPLOAD_FOLDER, '.incoming')
+
+# Endpoints taking exactly one image: a bad part aborts the request while it is still arriving
+SINGLE_IMAGE_ENDPOINTS = {'upload_file', 'categorize_image', 'search_by_image'}
+
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+    (b'PK\x03\x04', 'zip'),
+)
+IMAGE_FORMAT_EXTENSIONS = {'jpeg': '.jpg', 'png': '.png', 'gif': '.gif', 'bmp': '.bmp', 'webp': '.webp', 'tiff': '.tiff'}
+
+def sniff_file_format(head):
+    """Identify a file from its first bytes: an IMAGE_FORMAT_EXTENSIONS key, 'zip', or None."""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    for signature, file_format in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return file_format
+    return None
+
+class UploadStream:
+    """Temporary file that Werkzeug streams one multipart file part into.
+
+    Bytes are hashed as they arrive and the format is sniffed from the first
+    ones, so handlers get the SHA-256 without reading the file back. With
+    `strict`, an oversized or non-image part aborts the request while it is still
+    being received; otherwise it is only flagged so bulk requests can report it
+    per file.
+    """
+
+    SNIFF_BYTES = 16
+
+    def __init__(self, limit, strict):
+        os.makedirs(UPLOAD_TEMP_DIR, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=UPLOAD_TEMP_DIR, suffix='.part')
+        self.path = self._file.name
+        self.limit = limit
+        self.strict = strict
+        self.size = 0
+        self.format = None
+        self.too_large = False
+        self._head = b''
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            if self.strict:
+                raise RequestEntityTooLarge(f'File is larger than {self.limit} bytes')
+            # Keep consuming the part, but stop storing it
+            self.too_large = True
+            return len(data)
+        if len(self._head) < self.SNIFF_BYTES:
+            self._head += data[:self.SNIFF_BYTES - len(self._head)]
+            if len(self._head) >= self.SNIFF_BYTES:
+                self._sniff()
+        self._sha256.update(data)
+        return self._file.write(data)
+
+    def _sniff(self):
+        self.format = sniff_file_format(self._head)
+        if self.strict and self.format not in IMAGE_FORMAT_EXTENSIONS:
+            raise UnsupportedMediaType('File content is not a supported image format')
+
+    def finish(self):
+        """Sniff files shorter than SNIFF_BYTES, which write() could not classify."""
+        if self.format is None and self._head:
+            self._sniff()
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+class UploadRequest(Request):
+    @property
+    def max_content_length(self):
+        if self.endpoint in BATCH_ENDPOINTS:
+            return MAX_BATCH_REQUEST_BYTES
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        strict = self.endpoint in SINGLE_IMAGE_ENDPOINTS
+        if strict and filename and not allowed_file(filename):
+            raise UnsupportedMediaType('File type not allowed')
+        is_archive = not strict and filename and filename.lower().endswith('.zip')
+        return UploadStream(MAX_BATCH_REQUEST_BYTES if is_archive else MAX_UPLOAD_BYTES, strict)
+
+app.request_class = UploadRequest
+
+@app.before_request
+def reject_oversized_uploads():
+    """Refuse single-image requests whose declared size is too large before reading the body."""
+    if request.endpoint in SINGLE_IMAGE_ENDPOINTS and (request.content_length or 0) > MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD:
+        raise RequestEntityTooLarge(f'Upload is larger than {MAX_UPLOAD_BYTES} bytes')
+
+@app.errorhandler(RequestEntityTooLarge)
+@app.errorhandler(UnsupportedMediaType)
+def upload_rejected(e):
+    return jsonify({'error': e.description}), e.code
+
+def inspect_image_upload(file):
+    """Verify a received image part without decoding its pixels and return its UploadStream.
+
+    Raises UnsupportedMediaType for content that is not an image, RequestEntityTooLarge
+    for oversized files and ImageTooLargeError when the header declares more than
+    MAX_IMAGE_PIXELS, so decompression bombs are refused before any decoding.
+    """
+    stream = file.stream
+    stream.finish()
+    if stream.too_large:
+        raise RequestEntityTooLarge(f'File is larger than {stream.limit} bytes')
+    if stream.format not in IMAGE_FORMAT_EXTENSIONS:
+        raise UnsupportedMediaType('File content is not a supported image format')
+    stream.seek(0)
+    try:
+        with Image.open(stream) as image:
+            width, height = image.size
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e))
+    except Exception:
+        raise UnsupportedMediaType('File content is not a readable image')
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ImageTooLargeError(f"Image is {width}x{height}, limit is {MAX_IMAGE_PIXELS} pixels")
+    stream.seek(0)
+    return stream
+
+# Resized copies of each upload for product cards and grids, written next to the original
+IMAGE_VARIANT_WIDTHS = sorted(int(width) for width in os.getenv('IMAGE_VARIANT_WIDTHS', '200,400,800').split(',') if width.strip())
+IMAGE_VARIANT_WEBP = features.check('webp')
+IMAGE_VARIANT_BACKFILL = os.getenv('IMAGE_VARIANT_BACKFILL', 'on') == 'on'  # python app.py only
+UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600
+
+def save_image_atomically(image, path, **params):
+    """Save through a temporary file so a concurrent reader never sees a half-written image."""
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    image.save(temp_path, **params)
+    os.replace(temp_path, path)
+
+def generate_image_variants(source, filename):
+    """Write resized JPEG/PNG and WebP copies of an upload (bytes or a path) next to it (`filename` is relative to uploads/).
+
+    Returns [{'width': 200, 'jpg': url, 'webp': url}, ...] sorted by width. Widths
+    at or above the original's are skipped, since the original serves those.
+    """
+    image = Image.open(BytesIO(source) if isinstance(source, bytes) else source)
+    width, height = image.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ImageTooLargeError(f"Image is {width}x{height}, limit is {MAX_IMAGE_PIXELS} pixels")
+    if IMAGE_VARIANT_WIDTHS:
+        image.draft('RGB', (IMAGE_VARIANT_WIDTHS[-1], IMAGE_VARIANT_WIDTHS[-1]))
+    image = ImageOps.exif_transpose(image)
+
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    formats = {'png': {'format': 'PNG', 'optimize': True}} if has_alpha else \
+        {'jpg': {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True}}
+    if IMAGE_VARIANT_WEBP:
+        # method 2 encodes about 3x faster than the default 4 for a few percent larger files
+        formats['webp'] = {'format': 'WEBP', 'quality': 80, 'method': 2}
+
+    variants = []
+    # Largest width first, so each smaller variant is resized from the previous one
+    source = image
+    for width in reversed([width for width in IMAGE_VARIANT_WIDTHS if width < image.width]):
+        # reducing_gap box-reduces first, which is much cheaper than a full Lanczos pass and looks the same
+        source = source.resize((width, max(1, round(source.height * width / source.width))), Image.LANCZOS, reducing_gap=3.0)
+        variant = {'width': width}
+        for extension, params in formats.items():
+            name = variant_filename(filename, width, extension)
+            save_image_atomically(source, os.path.join(app.config['UPLOAD_FOLDER'], name), **params)
+            variant[extension] = f"/uploads/{name}"
+        variants.append(variant)
+    return sorted(variants, key=lambda variant: variant['width'])
+
+def backfill_image_variants():
+    """Generate variants for uploaded product images that have none yet; returns how many products were processed."""
+    conn = connect_db()
+    rows = conn.execute(
+        "SELECT id, image_url FROM products WHERE image_variants IS NULL AND image_url LIKE '/uploads/%'"
+    ).fetchall()
+    created = 0
+    for product_id, image_url in rows:
+        filename = image_url[len('/uploads/'):]
+        try:
+            variants = generate_image_variants(upload_path(image_url), filename)
+            created += 1
+        except Exception as e:
+            # Record an empty list so a missing or unreadable file is not retried on every start
+            print(f"Could not create image variants for {filename}: {str(e)}")
+            variants = []
+        conn.execute(
+            'UPDATE products SET image_variants = ? WHERE id = ? AND image_variants IS NULL',
+            (json.dumps(variants), product_id)
+        )
+        conn.commit()
+    conn.close()
+    if rows:
+        print(f"Created image variants for {created} of {len(rows)} existing products")
+    return len(rows)
+
+def start_image_variant_backfill():
+    thread = threading.Thread(target=backfill_image_variants, name='image-variant-backfill', daemon=True)
+    thread.start()
+    return thread
+
+@app.route('/api/upload', methods=['POST', 'OPTIONS'])
+def upload_file():
+    """Upload a product image, analyze it, and save the product for the authenticated user."""
+    if request.method == 'OPTIONS':
+        return '', 200
+    
+    try:
+        payload = get_jwt_payload()
+        if not payload or not payload.get('user_id'):
+            return jsonify({'error': 'Authorization header missing or invalid'}), 401
+        user_id = payload['user_id']
+        
+        # Form verilerini al
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file part'}), 400
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'error': 'No selected file'}), 400
+            
+        # Ürün bilgilerini al
+        name = request.form.get('name')
+        description = request.form.get('description')
+        price = request.form.get('price')
+        selected_categories = request.form.get('categories')  # JSON string olarak gelecek
+        
+        if not name or not description or not price or not selected_categories:
+            return jsonify({'error': 'Missing required product information'}), 400
+        
+        # Parse categories and price before anything is written to disk
+        import json
+        try:
+            categories_list = json.loads(selected_categories)
+        except ValueError:
+            return jsonify({'error': 'categories must be a JSON list'}), 400
+        if not isinstance(categories_list, list):
+            return jsonify({'error': 'categories must be a list'}), 400
+        try:
+            price = float(price)
+        except ValueError:
+            return jsonify({'error': 'price must be a number'}), 400
+        
+        # The part was streamed to a temp file and hashed on arrival; check the header before using it
+        try:
+            upload = inspect_image_upload(file)
+        except ImageTooLargeError as e:
+            return jsonify({'error': str(e)}), 413
+        
+        filename = secure_filename(file.filename)
+        timestamp = str(int(time.time() * 1000))
+        digest = upload.hexdigest()
+        conn = get_db()
+        c = conn.cursor()
+        
+        # Keep the CLIP embedding; it is usually still cached from /api/categorize
+        try:
+            embedding = image_embedding_for_upload(upload)
+        except Exception as e:
+            print(f"Could not compute image embedding for {filename}: {str(e)}")
+            embedding = None
+        
+        # Get user info for seller name
+        
+        c.execute('SELECT name_surname, email FROM users WHERE id = ?', (user_id,))
+        user_info = c.fetchone()
+        seller_name = user_info[0] if user_info and user_info[0] else user_info[1].split('@')[0] if user_info else 'Unknown Seller'
+        
+        # Save the file under the hash of its bytes; an image already stored by another product is reused.
+        # Its variants are read after store_blob, whose reference keeps a concurrent delete from removing them
+        product_id = timestamp
+        image_url = store_blob(c, digest, upload.size, IMAGE_FORMAT_EXTENSIONS[upload.format], upload.path)
+        c.execute(
+            'SELECT image_variants FROM products WHERE image_url = ? AND image_variants IS NOT NULL LIMIT 1',
+            (image_url,)
+        )
+        row = c.fetchone()
+        image_variants = json.loads(row[0]) if row else None
+        insert_query = '''
+            INSERT INTO products (id, name, description, image_url, image_variants, categories, price, user_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        '''
         insert_values = (
             product_id,
             name,
             description,
-            f"/uploads/{unique_filename}",
+            image_url,
+            json.dumps(image_variants) if image_variants is not None else None,
             json.dumps(categories_list),
-            float(price),
+            price,
             user_id
         )
         
         c.execute(insert_query, insert_values)
+        save_product_categories(c, product_id, categories_list)
+        if embedding is not None:
+            save_product_embedding(c, product_id, embedding)
         conn.commit()
-        conn.close()
+        if embedding is not None:
+            product_vector_index.add(product_id, embedding)
+        
+        # A new image gets its variants once the product holds a reference to it
+        if image_variants is None:
+            try:
+                image_variants = generate_image_variants(upload.path, image_url[len('/uploads/'):])
+            except Exception as e:
+                print(f"Could not create image variants for {filename}: {str(e)}")
+                image_variants = []
+            c.execute('UPDATE products SET image_variants = ? WHERE id = ?', (json.dumps(image_variants), product_id))
+            conn.commit()
         
         product_data = {
             'id': product_id,
             'name': name,
             'description': description,
-            'image_url': f"/uploads/{unique_filename}",
+            'image_url': image_url,
+            'image_variants': image_variants,
             'categories': categories_list,
-            'price': float(price),
+            'price': price,
             'seller': seller_name,
             'user_id': user_id
         }
         
         return jsonify(product_data)
         
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Serialized catalog responses keyed by catalog version, so a write makes every older entry unreachable
+CATALOG_RESPONSE_CACHE_SIZE = int(os.getenv('CATALOG_RESPONSE_CACHE_SIZE', '256'))
+catalog_response_cache = TieredCache('catalog_responses', CATALOG_RESPONSE_CACHE_SIZE)
+
+def catalog_version(conn):
+    """Return the catalog version counter maintained by triggers on products and users."""
+    return conn.execute('SELECT version FROM catalog_version WHERE id = 1').fetchone()[0]
+
+def conditional_catalog_response(build, scope='catalog'):
+    """Serve a catalog read with an ETag derived from the catalog version.
+
+    `build(conn)` returns (payload, status). A matching If-None-Match gets a 304
+    after a single version lookup; otherwise the serialized 200 body is reused
+    from catalog_response_cache until the catalog changes. `scope` separates
+    per-user responses, which are also marked private.
+    """
+    conn = get_db()
+    etag = f'{scope}-{catalog_version(conn)}'
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        key = f'{etag}:{request.full_path}'
+        body = catalog_response_cache.get(key)
+        if body is None:
+            payload, status = build(conn)
+            if status != 200:
+                return jsonify(payload), status
+            body = jsonify(payload).get_data(as_text=True)
+            catalog_response_cache.set(key, body)
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    if scope == 'catalog':
+        response.headers['Cache-Control'] = 'no-cache'
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Authorization')
+    return response
+
+# Use explicit column selection to ensure correct mapping
+SELLER_PRODUCTS_QUERY = '''
+    SELECT id, name, image_url, categories, created_at, user_id, description, price, image_variants
+    FROM products
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+'''
+
+def seller_products_payload(conn, user_id):
+    c = conn.cursor()
+    c.execute(SELLER_PRODUCTS_QUERY, (user_id,))
+    products = c.fetchall()
+
+    product_list = []
+    for product in products:
+        # Correct column mapping: 0:id, 1:name, 2:image_url, 3:categories, 4:created_at, 5:user_id, 6:description, 7:price, 8:image_variants
+        categories = parse_categories_column(product[3])
+        product_list.append({
+            'id': product[0],
+            'name': product[1],
+            'image_url': product[2],
+            'image_variants': json.loads(product[8]) if product[8] else [],
+            'categories': categories,
+            'description': product[6] if product[6] else f"Description for {product[1]}",
+            'price': product[7] if product[7] else 0.0,
+            'created_at': product[4]
+        })
+    return product_list
+
 @app.route('/api/products', methods=['GET', 'POST'])
 def get_products():
     """Get all products belonging to the authenticated user or add a new product."""
@@ -449,41 +2047,12 @@ def get_products():
     if not payload or not payload.get('user_id'):
         return jsonify({'error': 'Authorization header missing or invalid'}), 401
     user_id = payload['user_id']
-    conn = sqlite3.connect('products.db')
+    conn = get_db()
     c = conn.cursor()
     if request.method == 'GET':
-        # Use explicit column selection to ensure correct mapping
-        c.execute('''
-            SELECT id, name, image_url, categories, created_at, user_id, description, price 
-            FROM products 
-            WHERE user_id = ? 
-            ORDER BY created_at DESC
-        ''', (user_id,))
-        products = c.fetchall()
-        conn.close()
-        
-        product_list = []
-        for product in products:
-            try:
-                # Correct column mapping: 0:id, 1:name, 2:image_url, 3:categories, 4:created_at, 5:user_id, 6:description, 7:price
-                categories_data = product[3] if product[3] else '[]'
-                if isinstance(categories_data, str):
-                    categories = json.loads(categories_data)
-                else:
-                    categories = categories_data
-            except (json.JSONDecodeError, TypeError):
-                categories = []
-                
-            product_list.append({
-                'id': product[0],
-                'name': product[1],
-                'image_url': product[2],
-                'categories': categories,
-                'description': product[6] if product[6] else f"Description for {product[1]}",
-                'price': product[7] if product[7] else 0.0,
-                'created_at': product[4]
-            })
-        return jsonify(product_list)
+        return conditional_catalog_response(
+            lambda conn: (seller_products_payload(conn, user_id), 200), scope=f'user-{user_id}'
+        )
     elif request.method == 'POST':
         data = request.get_json()
         name = data.get('name')
@@ -493,6 +2062,13 @@ def get_products():
         image = data.get('image')  # Demo amaçlı, gerçek uygulamada dosya upload ayrı olmalı
         if not name or not description or not price or not categories:
             return jsonify({'error': 'Missing required fields'}), 400
+        if not isinstance(categories, list):
+            return jsonify({'error': 'categories must be a list'}), 400
+        if image is not None and not isinstance(image, str):
+            return jsonify({'error': 'image must be a URL'}), 400
+        # Uploaded images are only referenced by their blob URL (from /api/upload)
+        if not retain_blob(c, image):
+            return jsonify({'error': 'image is not a known upload'}), 400
         # Demo: ürün id'si olarak timestamp kullan
         import time
         product_id = str(int(time.time() * 1000))
@@ -503,17 +2079,23 @@ def get_products():
             product_id,
             name,
             image if image else '',
-            str(categories),
+            json.dumps(categories),
             float(price),
             user_id
         ))
+        save_product_categories(c, product_id, categories)
         conn.commit()
-        conn.close()
         return jsonify({'message': 'Product saved successfully!'}), 201
 
-@app.route('/uploads/<filename>')
+@app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Hidden paths hold uploads still being received
+    if any(part.startswith('.') for part in filename.split('/')):
+        return jsonify({'error': 'Not found'}), 404
+    # Uploads are named by the hash of their content, so a URL always serves the same bytes
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, max_age=UPLOAD_CACHE_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={UPLOAD_CACHE_MAX_AGE}, immutable'
+    return response
 
 @app.route('/api/products/<product_id>', methods=['PUT', 'DELETE', 'OPTIONS'])
 def manage_product(product_id):
@@ -529,19 +2111,17 @@ def manage_product(product_id):
     user_id = payload['user_id']
     
     try:
-        conn = sqlite3.connect('products.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # First check if product exists and get its user_id
         cursor.execute('SELECT user_id FROM products WHERE id = ?', (product_id,))
         result = cursor.fetchone()
         if not result:
-            conn.close()
             return jsonify({'error': 'Product not found'}), 404
         
         product_user_id = result[0]
         if str(product_user_id) != str(user_id):
-            conn.close()
             return jsonify({'error': 'You are not authorized to modify this product.'}), 403
         
         if request.method == 'PUT':
@@ -552,7 +2132,6 @@ def manage_product(product_id):
             price = data.get('price')
             
             if not name or not description or price is None:
-                conn.close()
                 return jsonify({'error': 'Missing required fields'}), 400
             
             cursor.execute('''
@@ -562,7 +2141,6 @@ def manage_product(product_id):
             ''', (name, description, float(price), product_id))
             
             conn.commit()
-            conn.close()
             return jsonify({'message': 'Product updated successfully'}), 200
             
         elif request.method == 'DELETE':
@@ -571,22 +2149,18 @@ def manage_product(product_id):
             result = cursor.fetchone()
             image_url = result[0] if result else None
             
-            image_path = os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(image_url)) if image_url else None
-            
-            # Delete from database first
             cursor.execute('DELETE FROM products WHERE id = ?', (product_id,))
+            cursor.execute('DELETE FROM product_categories WHERE product_id = ?', (product_id,))
+            cursor.execute('DELETE FROM product_embeddings WHERE product_id = ?', (product_id,))
+            # The image files go only when no other product uses the same image, and only once the delete is committed
+            released_path = release_blob(cursor, image_url)
             conn.commit()
-            conn.close()
-            
-            # Then try to delete the image file if it exists
-            if image_path and os.path.exists(image_path):
-                os.remove(image_path)
+            remove_released_blob(conn, released_path)
+            product_vector_index.remove(product_id)
             
             return jsonify({'message': 'Product deleted successfully'}), 200
             
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/register', methods=['POST'])
@@ -603,16 +2177,14 @@ def register_user():
     
     if not email or not password:
         return jsonify({'error': 'Email and password are required.'}), 400
-    conn = sqlite3.connect('products.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT id FROM users WHERE email = ?', (email,))
     if c.fetchone():
-        conn.close()
         return jsonify({'error': 'Email already registered'}), 400
     hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
     c.execute('INSERT INTO users (email, password_hash, role) VALUES (?, ?, ?)', (email, hashed_password, role))
     conn.commit()
-    conn.close()
     return jsonify({'message': f'User registered successfully as {role}'}), 201
 
 @app.route('/api/login', methods=['POST'])
@@ -623,11 +2195,10 @@ def login_user():
     password = data.get('password')
     if not email or not password:
         return jsonify({'error': 'Email and password are required.'}), 400
-    conn = sqlite3.connect('products.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT id, password_hash, role FROM users WHERE email = ?', (email,))
     user = c.fetchone()
-    conn.close()
     if not user or not bcrypt.checkpw(password.encode('utf-8'), user[1] if isinstance(user[1], bytes) else user[1].encode('utf-8')):
         return jsonify({'error': 'Invalid email or password.'}), 401
     payload = {
@@ -666,7 +2237,7 @@ def seller_required(f):
 @app.route('/api/users', methods=['GET'])
 @seller_required
 def get_all_users():
-    conn = sqlite3.connect('products.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT id, email, role, name_surname, address, phone FROM users')
     users = [
@@ -680,18 +2251,16 @@ def get_all_users():
         }
         for row in c.fetchall()
     ]
-    conn.close()
     return jsonify(users)
 
 # Belirli bir kullanıcının detaylarını getir (seller yetkisi ile)
 @app.route('/api/users/<int:user_id>', methods=['GET'])
 @seller_required
 def get_user_detail(user_id):
-    conn = sqlite3.connect('products.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT id, email, role FROM users WHERE id = ?', (user_id,))
     row = c.fetchone()
-    conn.close()
     if row:
         user = {'id': row[0], 'email': row[1], 'role': row[2]}
         return jsonify(user)
@@ -726,20 +2295,18 @@ def update_user(user_id):
     address = data.get('address')
     phone = data.get('phone')
 
-    conn = sqlite3.connect('products.db')
+    conn = get_db()
     c = conn.cursor()
     # Benzersiz email kontrolü
     if email:
         c.execute('SELECT id FROM users WHERE email = ? AND id != ?', (email, user_id))
         if c.fetchone():
-            conn.close()
             return jsonify({'error': 'Email already in use.'}), 409
 
     # Mevcut kullanıcıyı çek
     c.execute('SELECT id, email, role, name_surname, address, phone FROM users WHERE id = ?', (user_id,))
     user = c.fetchone()
     if not user:
-        conn.close()
         return jsonify({'error': 'User not found'}), 404
 
     # Alanları güncelle
@@ -769,7 +2336,6 @@ def update_user(user_id):
     # Güncellenmiş kullanıcıyı döndür
     c.execute('SELECT id, email, role, name_surname, address, phone FROM users WHERE id = ?', (user_id,))
     updated_user = c.fetchone()
-    conn.close()
     user_dict = {
         'id': updated_user[0],
         'email': updated_user[1],
@@ -786,11 +2352,10 @@ def update_self():
     if not payload:
         return jsonify({'error': 'Authorization header missing or invalid'}), 401
     email = payload['email']
-    conn = sqlite3.connect('products.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT id FROM users WHERE email = ?', (email,))
     user = c.fetchone()
-    conn.close()
     if not user:
         return jsonify({'error': 'User not found'}), 404
     user_id = user[0]
@@ -812,11 +2377,10 @@ def get_profile():
     if not payload:
         return jsonify({'error': 'Authorization header missing or invalid'}), 401
     email = payload['email']
-    conn = sqlite3.connect('products.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT id, email, role, name_surname, address, phone FROM users WHERE email = ?', (email,))
     user = c.fetchone()
-    conn.close()
     if not user:
         return jsonify({'error': 'User not found'}), 404
     # Tüm rollerde aynı bilgileri döndür
@@ -838,127 +2402,1022 @@ def categorize_image():
         if file.filename == '':
             return jsonify({'error': 'No selected file'}), 400
         
-        # Save the file
-        filename = secure_filename(file.filename)
-        timestamp = str(int(time.time() * 1000))
-        unique_filename = f"temp_{timestamp}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        
-        file.save(filepath)
-        
-        # Analyze the image
-        results = analyze_image(filepath)
-        
-        # Clean up temporary file
+        # Re-uploads of the same photo are answered from the content-hash cache
         try:
-            os.remove(filepath)
-        except:
-            pass
-        
+            upload = inspect_image_upload(file)
+        except ImageTooLargeError as e:
+            return jsonify({'error': str(e)}), 413
+        cache_key = categorization_cache_key_for_digest(upload.hexdigest())
+        cached = categorization_cache.get(cache_key)
+        if cached:
+            return jsonify({'categories': cached['categories']})
+
+        # Decode from the spooled upload at no more resolution than CLIP needs
+        try:
+            image = decode_image(upload)
+        except ImageTooLargeError as e:
+            return jsonify({'error': str(e)}), 413
+        except Exception as e:
+            return jsonify({'error': f'Invalid image file: {str(e)}'}), 400
+
+        # Analyze the image; concurrent requests share batched forward passes
+        try:
+            results, embedding = categorize_batcher.submit(image).result()
+            if results:
+                cache_categorization(cache_key, results, embedding)
+        except Exception as e:
+            print(f"Error in categorize_image: {str(e)}")
+            results = []
+
         if not results:
             return jsonify({'error': 'AI categorization failed - could not analyze image'}), 500
             
         return jsonify({'categories': results})
         
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
-@app.route('/api/all-products', methods=['GET', 'OPTIONS'])
-def get_all_products():
-    if request.method == 'OPTIONS':
-        return '', 200
-        
+# Bulk categorization: images per forward pass and archive limits
+CATEGORIZE_BATCH_SIZE = int(os.getenv('CATEGORIZE_BATCH_SIZE', '16'))
+MAX_BATCH_IMAGES = int(os.getenv('MAX_BATCH_IMAGES', '1000'))
+MAX_ARCHIVE_MEMBER_BYTES = int(os.getenv('MAX_ARCHIVE_MEMBER_BYTES', str(20 * 1024 * 1024)))
+
+def iter_batch_images():
+    """Yield (filename, image bytes, error) for every image in a bulk categorization request.
+
+    Images come from repeated `images` multipart fields and/or a zip `archive`.
+    Archive members are read one at a time so memory stays bounded. Images past
+    MAX_BATCH_IMAGES are not read and get an error instead.
+    """
+    limit_error = f'Batch limit of {MAX_BATCH_IMAGES} images exceeded'
+    count = 0
+    for file in request.files.getlist('images'):
+        if count >= MAX_BATCH_IMAGES:
+            yield file.filename, None, limit_error
+            continue
+        count += 1
+        file.stream.finish()
+        if not file.filename or not allowed_file(file.filename) or file.stream.format not in IMAGE_FORMAT_EXTENSIONS:
+            yield file.filename, None, 'Unsupported file type'
+            continue
+        if file.stream.too_large:
+            yield file.filename, None, 'File too large'
+            continue
+        yield file.filename, file.read(), None
+
+    archive = request.files.get('archive')
+    if not archive:
+        return
+    if archive.stream.too_large:
+        yield archive.filename, None, 'Archive too large'
+        return
     try:
-        conn = sqlite3.connect('products.db')
-        c = conn.cursor()
-        c.execute('''
-            SELECT p.id, p.name, p.image_url, p.categories, p.created_at, p.user_id, p.description, p.price, u.name_surname, u.email 
-            FROM products p 
-            LEFT JOIN users u ON p.user_id = u.id 
-            ORDER BY p.created_at DESC
-        ''')
-        products = c.fetchall()
-        conn.close()
-        
-        product_list = []
-        for product in products:
-            try:
-                # Correct column mapping based on actual schema:
-                # 0: id, 1: name, 2: image_url, 3: categories, 4: created_at, 5: user_id, 6: description, 7: price, 8: name_surname, 9: email
-                product_id = product[0]
-                name = product[1]
-                image_url = product[2]
-                categories_data = product[3] if product[3] else '[]'
-                description = product[6] if product[6] else f"Description for {name}"
-                price = product[7] if product[7] else 0.0
-                user_name_surname = product[8]
-                user_email = product[9]
-                
-                # Safely parse categories JSON
-                if isinstance(categories_data, str):
-                    categories = json.loads(categories_data)
+        with zipfile.ZipFile(archive.stream) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or os.path.basename(info.filename).startswith('.'):
+                    continue
+                if count >= MAX_BATCH_IMAGES:
+                    yield info.filename, None, limit_error
+                    continue
+                count += 1
+                if not allowed_file(info.filename):
+                    yield info.filename, None, 'Unsupported file type'
+                elif info.file_size > MAX_ARCHIVE_MEMBER_BYTES:
+                    yield info.filename, None, 'File too large'
                 else:
-                    categories = categories_data
-                    
-            except (json.JSONDecodeError, TypeError) as e:
-                categories = []  # Fallback to empty array
-            
-            seller_name = user_name_surname if user_name_surname else user_email.split('@')[0] if user_email else 'Unknown Seller'
-            
-            product_dict = {
-                'id': product_id,
-                'name': name,
-                'description': description,
-                'image_url': image_url,
-                'categories': categories,
-                'price': float(price),
-                'seller': seller_name
-            }
-            
-            product_list.append(product_dict)
-            
-        return jsonify(product_list)
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+                    yield info.filename, zf.read(info), None
+    except zipfile.BadZipFile:
+        yield archive.filename, None, 'Invalid zip archive'
 
-@app.route('/')
-def home():
-    return jsonify({'message': 'AI Product Categorizer API is running!'})
+@app.route('/api/categorize/batch', methods=['POST'])
+def categorize_batch():
+    """Categorize many images (multipart `images` fields or a zip `archive`) and stream NDJSON results"""
+    if 'images' not in request.files and 'archive' not in request.files:
+        return jsonify({'error': 'No images uploaded'}), 400
 
-def extract_info_from_product_name(product_name):
-    """Extract useful information from product name"""
-    name_lower = product_name.lower()
-    
-    # Extract brand if mentioned
-    brands = ['apple', 'samsung', 'nike', 'adidas', 'sony', 'lg', 'hp', 'dell', 'canon', 'nikon']
-    brand = next((b for b in brands if b in name_lower), None)
-    
-    # Extract colors
-    colors = ['black', 'white', 'red', 'blue', 'green', 'yellow', 'pink', 'purple', 'gray', 'grey', 'silver', 'gold']
-    color = next((c for c in colors if c in name_lower), None)
-    
-    # Extract sizes
-    sizes = ['xs', 'small', 'medium', 'large', 'xl', 'xxl', '32gb', '64gb', '128gb', '256gb', '512gb', '1tb']
-    size = next((s for s in sizes if s in name_lower), None)
-    
-    # Extract materials
-    materials = ['cotton', 'silk', 'leather', 'plastic', 'metal', 'wood', 'glass', 'ceramic']
-    material = next((m for m in materials if m in name_lower), None)
-    
-    return {
-        'brand': brand,
-        'color': color, 
-        'size': size,
-        'material': material,
-        'original_name': product_name
-    }
+    def line(index, filename, **fields):
+        return json.dumps({'index': index, 'filename': filename, **fields}) + '\n'
 
-def generate_product_description_with_name_and_image(product_name, category_names, image_path=None):
-    """Generate description with optional image analysis using Gemini Vision"""
-    print(f"Generating description with image path: {image_path}")
-    print(f"GEMINI_API_KEY available: {bool(GEMINI_API_KEY and GEMINI_API_KEY != 'your_gemini_api_key_here')}")
-    
+    def score(chunk):
+        try:
+            results = classify_images_with_embeddings([image for _, _, _, image in chunk])
+            for (index, filename, cache_key, _), (categories, embedding) in zip(chunk, results):
+                cache_categorization(cache_key, categories, embedding)
+                yield line(index, filename, categories=categories)
+        except Exception as e:
+            print(f"Error in categorize_batch: {str(e)}")
+            for index, filename, _, _ in chunk:
+                yield line(index, filename, error='AI categorization failed')
+
+    def generate():
+        chunk = []
+        for index, (filename, image_bytes, error) in enumerate(iter_batch_images()):
+            if error:
+                yield line(index, filename, error=error)
+                continue
+
+            cache_key = categorization_cache_key(image_bytes)
+            cached = categorization_cache.get(cache_key)
+            if cached:
+                yield line(index, filename, categories=cached['categories'])
+                continue
+
+            try:
+                image = decode_image(BytesIO(image_bytes))
+            except Exception as e:
+                yield line(index, filename, error=f'Could not read image: {str(e)}')
+                continue
+
+            chunk.append((index, filename, cache_key, image))
+            if len(chunk) >= CATEGORIZE_BATCH_SIZE:
+                yield from score(chunk)
+                chunk = []
+        if chunk:
+            yield from score(chunk)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/inference/metrics', methods=['GET'])
+def inference_metrics():
+    """Report micro-batching and categorization cache statistics"""
+    return jsonify({
+        'categorize_batcher': categorize_batcher.metrics(),
+        'categorization_cache': categorization_cache.stats(),
+        'query_embedding_cache': query_embedding_cache.stats(),
+        'description_cache': description_cache.stats(),
+        'gemini_image_cache': gemini_image_cache.stats(),
+        'description_jobs': job_queue.metrics()
+    })
+
+# Columns selected for catalog listings, in the order product_row_to_dict expects
+CATALOG_PRODUCT_COLUMNS = '''
+    p.id, p.name, p.image_url, p.categories, p.created_at, p.user_id, p.description, p.price, u.name_surname, u.email,
+    p.image_variants
+'''
+ALL_PRODUCTS_QUERY = f'''
+    SELECT {CATALOG_PRODUCT_COLUMNS}
+    FROM products p
+    LEFT JOIN users u ON p.user_id = u.id
+    ORDER BY p.created_at DESC
+'''
+
+def product_row_to_dict(product):
+    """Convert a CATALOG_PRODUCT_COLUMNS row into the product JSON returned by catalog endpoints."""
+    # 0: id, 1: name, 2: image_url, 3: categories, 4: created_at, 5: user_id, 6: description, 7: price, 8: name_surname, 9: email,
+    # 10: image_variants
+    name = product[1]
+    categories = parse_categories_column(product[3])
+
+    user_name_surname = product[8]
+    user_email = product[9]
+    seller_name = user_name_surname if user_name_surname else user_email.split('@')[0] if user_email else 'Unknown Seller'
+
+    return {
+        'id': product[0],
+        'name': name,
+        'description': product[6] if product[6] else f"Description for {name}",
+        'image_url': product[2],
+        'image_variants': json.loads(product[10]) if product[10] else [],
+        'categories': categories,
+        'price': float(product[7] if product[7] else 0.0),
+        'seller': seller_name
+    }
+
+def fetch_products_by_ids(conn, product_ids):
+    """Fetch catalog products by id, keeping the given order and skipping ids that no longer exist."""
+    if not product_ids:
+        return []
+    placeholders = ', '.join('?' for _ in product_ids)
+    c = conn.cursor()
+    c.execute(f'''
+        SELECT {CATALOG_PRODUCT_COLUMNS}
+        FROM products p
+        LEFT JOIN users u ON p.user_id = u.id
+        WHERE p.id IN ({placeholders})
+    ''', list(product_ids))
+    rows = {row[0]: row for row in c.fetchall()}
+    return [product_row_to_dict(rows[product_id]) for product_id in product_ids if product_id in rows]
+
+# Catalog pagination: keyset cursors over (sort column, id)
+CATALOG_PAGE_SIZE = int(os.getenv('CATALOG_PAGE_SIZE', '24'))
+CATALOG_MAX_PAGE_SIZE = int(os.getenv('CATALOG_MAX_PAGE_SIZE', '100'))
+CATALOG_QUERY_ARGS = {'limit', 'cursor', 'category', 'min_price', 'max_price', 'seller', 'sort'}
+CATALOG_SORTS = {
+    'recent': ('p.created_at', 'DESC'),
+    'price_asc': ('p.price', 'ASC'),
+    'price_desc': ('p.price', 'DESC'),
+}
+
+def encode_cursor(values):
+    """Encode keyset values as an opaque URL-safe cursor."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor; raises ValueError when it is malformed."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    # Values are bound straight into SQL, so only scalars are accepted
+    if not isinstance(values, list) or not all(value is None or isinstance(value, (str, int, float)) for value in values):
+        raise ValueError('Invalid cursor')
+    return values
+
+def parse_page_size(args):
+    """Read the `limit` argument, clamped to CATALOG_MAX_PAGE_SIZE."""
+    try:
+        limit = int(args.get('limit', CATALOG_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    return max(1, min(limit, CATALOG_MAX_PAGE_SIZE))
+
+def category_matches_query(args):
+    """Return the SQL selecting ids of products in any requested category, and its parameters (None if no category)."""
+    categories = [category for category in args.getlist('category') if category]
+    if not categories:
+        return None, []
+    # A category matches its own path and every path below it; both are ranges on
+    # idx_product_categories_path ("X - " <= path < "X -!" covers every "X - ..." path)
+    matches = []
+    params = []
+    for category in categories:
+        matches.append('category_path = ? OR (category_path >= ? AND category_path < ?)')
+        params.extend([category, f'{category} - ', f'{category} -!'])
+    return f"SELECT product_id FROM product_categories WHERE {' OR '.join(matches)}", params
+
+def build_catalog_filters(args, categories=True):
+    """Build WHERE conditions and parameters for the category, price and seller filters."""
+    conditions = []
+    params = []
+
+    category_sql, category_params = category_matches_query(args) if categories else (None, [])
+    if category_sql:
+        conditions.append(f'p.id IN ({category_sql})')
+        params.extend(category_params)
+
+    for arg, operator in (('min_price', '>='), ('max_price', '<=')):
+        if args.get(arg):
+            try:
+                params.append(float(args.get(arg)))
+            except ValueError:
+                raise ValueError(f'{arg} must be a number')
+            conditions.append(f'p.price {operator} ?')
+
+    if args.get('seller'):
+        try:
+            params.append(int(args.get('seller')))
+        except ValueError:
+            raise ValueError('seller must be a user id')
+        conditions.append('p.user_id = ?')
+
+    return conditions, params
+
+def build_catalog_query(args):
+    """Build the SQL, parameters and page size of one catalog page request."""
+    sort = args.get('sort', 'recent')
+    if sort not in CATALOG_SORTS:
+        raise ValueError(f"sort must be one of: {', '.join(CATALOG_SORTS)}")
+    column, direction = CATALOG_SORTS[sort]
+    limit = parse_page_size(args)
+    conditions, params = build_catalog_filters(args, categories=False)
+
+    # With a category, read its products from idx_product_categories_path first and sort
+    # only those; otherwise SQLite may walk the whole sort index probing each product
+    source = 'products p'
+    category_sql, category_params = category_matches_query(args)
+    if category_sql:
+        source = f'(SELECT DISTINCT product_id FROM ({category_sql})) category_matches CROSS JOIN products p ON p.id = category_matches.product_id'
+        params = category_params + params
+
+    if args.get('cursor'):
+        cursor_values = decode_cursor(args.get('cursor'))
+        if len(cursor_values) != 2:
+            raise ValueError('Invalid cursor')
+        conditions.append(f"({column}, p.id) {'<' if direction == 'DESC' else '>'} (?, ?)")
+        params.extend(cursor_values)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    sql = f'''
+        SELECT {CATALOG_PRODUCT_COLUMNS}, {column}
+        FROM {source}
+        LEFT JOIN users u ON p.user_id = u.id
+        {where}
+        ORDER BY {column} {direction}, p.id {direction}
+        LIMIT ?
+    '''
+    return sql, params + [limit + 1], limit
+
+def query_catalog_page(conn, args):
+    """Return one page of catalog products and the cursor of the next page."""
+    sql, params, limit = build_catalog_query(args)
+    c = conn.cursor()
+    c.execute(sql, params)
+    rows = c.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][-1], rows[-1][0]])
+    return [product_row_to_dict(row) for row in rows], next_cursor
+
+def all_products_payload(conn, args):
+    """Build the /api/all-products payload and status for the given query arguments."""
+    # Paged mode: ?limit=&cursor=&category=&min_price=&max_price=&seller=&sort=
+    if CATALOG_QUERY_ARGS & set(args):
+        try:
+            products, next_cursor = query_catalog_page(conn, args)
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        return {
+            'products': products,
+            'next_cursor': next_cursor,
+            'limit': parse_page_size(args)
+        }, 200
+
+    c = conn.cursor()
+    c.execute(ALL_PRODUCTS_QUERY)
+    return [product_row_to_dict(product) for product in c.fetchall()], 200
+
+@app.route('/api/all-products', methods=['GET', 'OPTIONS'])
+def get_all_products():
+    """List catalog products; any of the pagination/filter arguments switches to paged responses."""
+    if request.method == 'OPTIONS':
+        return '', 200
+        
+    try:
+        return conditional_catalog_response(lambda conn: all_products_payload(conn, request.args))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Full-text search: BM25 weights for the name, description and categories columns
+SEARCH_COLUMN_WEIGHTS = (10.0, 1.0, 4.0)
+SEARCH_MAX_TERMS = 8
+SEARCH_MARK_START, SEARCH_MARK_END = '\ue000', '\ue001'
+
+def build_search_match(q):
+    """Turn free text into an FTS5 query where every word is a prefix term, or None if it has no words."""
+    terms = re.findall(r'\w+', q.lower())[:SEARCH_MAX_TERMS]
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"*' for term in terms)
+
+def render_search_highlight(text):
+    """HTML-escape a snippet and turn the FTS5 match markers into <mark> tags."""
+    if not text:
+        return text
+    return html.escape(text).replace(SEARCH_MARK_START, '<mark>').replace(SEARCH_MARK_END, '</mark>')
+
+def query_search_page(conn, match, args):
+    """Return one page of search results ranked by BM25 and the cursor of the next page."""
+    limit = parse_page_size(args)
+    conditions, params = build_catalog_filters(args)
+    # FTS5's rank column scores each match once with the configured BM25 weights
+    conditions[:0] = ['products_fts MATCH ?', 'rank MATCH ?']
+    params[:0] = [match, f"bm25({', '.join(str(weight) for weight in SEARCH_COLUMN_WEIGHTS)})"]
+
+    if args.get('cursor'):
+        cursor_values = decode_cursor(args.get('cursor'))
+        if len(cursor_values) != 2:
+            raise ValueError('Invalid cursor')
+        conditions.append('(rank, products_fts.rowid) > (?, ?)')
+        params.extend(cursor_values)
+
+    c = conn.cursor()
+    c.execute(f'''
+        SELECT {CATALOG_PRODUCT_COLUMNS},
+               highlight(products_fts, 0, ?, ?),
+               snippet(products_fts, 1, ?, ?, '…', 16),
+               rank,
+               products_fts.rowid
+        FROM products_fts
+        JOIN products p ON p.rowid = products_fts.rowid
+        LEFT JOIN users u ON p.user_id = u.id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY rank, products_fts.rowid
+        LIMIT ?
+    ''', [SEARCH_MARK_START, SEARCH_MARK_END] * 2 + params + [limit + 1])
+    rows = c.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][-2], rows[-1][-1]])
+
+    products = []
+    for row in rows:
+        product = product_row_to_dict(row)
+        product['highlights'] = {
+            'name': render_search_highlight(row[-4]),
+            'description': render_search_highlight(row[-3])
+        }
+        product['score'] = -row[-2]
+        products.append(product)
+    return products, next_cursor
+
+# Hybrid search: keyword (BM25) and CLIP text-to-image ranks merged with reciprocal rank fusion
+SEARCH_MODES = ('keyword', 'hybrid')
+HYBRID_SEARCH_BUDGET_MS = float(os.getenv('HYBRID_SEARCH_BUDGET_MS', '150'))
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', '100'))
+HYBRID_SEMANTIC_WEIGHT = float(os.getenv('HYBRID_SEMANTIC_WEIGHT', '1.0'))
+HYBRID_MIN_SIMILARITY = float(os.getenv('HYBRID_MIN_SIMILARITY', '0.2'))
+HYBRID_MAX_PENDING_ENCODES = int(os.getenv('HYBRID_MAX_PENDING_ENCODES', '16'))
+HYBRID_RRF_K = 60
+QUERY_PROMPT_TEMPLATE = 'a photo of {}'
+
+# One encoder thread: a burst of new queries queues up instead of competing for CPU with
+# categorization, and at most HYBRID_MAX_PENDING_ENCODES of them wait or run at once
+_query_encoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='query-encoder')
+_pending_query_embeddings = {}
+_pending_query_lock = threading.Lock()
+
+def query_embedding_key(q):
+    """Cache key for a query: its lowercased words plus the image embedding version."""
+    words = ' '.join(re.findall(r'\w+', q.lower()))
+    return f"{words}:{image_embedding_version()}"
+
+def encode_search_query(key, q):
+    """Encode a search query with the CLIP text tower and cache the result."""
+    try:
+        embedding = encode_text_prompts([QUERY_PROMPT_TEMPLATE.format(q)])[0]
+        query_embedding_cache.set(key, base64.b64encode(embedding_to_blob(embedding)).decode('ascii'))
+        return embedding
+    finally:
+        with _pending_query_lock:
+            _pending_query_embeddings.pop(key, None)
+
+def query_text_embedding(q, timeout):
+    """Return the query's CLIP text embedding, or None if it is not ready within `timeout` seconds.
+
+    On a timeout the encoding keeps running in the background and lands in the
+    cache, so the next identical query gets the semantic results. When
+    HYBRID_MAX_PENDING_ENCODES encodings are already pending, a new query is not
+    submitted at all and gets None straight away.
+    """
+    key = query_embedding_key(q)
+    cached = query_embedding_cache.get(key)
+    if cached:
+        return blob_to_embedding(base64.b64decode(cached))
+
+    with _pending_query_lock:
+        future = _pending_query_embeddings.get(key)
+        if future is None:
+            if len(_pending_query_embeddings) >= HYBRID_MAX_PENDING_ENCODES:
+                return None
+            future = _query_encoder.submit(encode_search_query, key, q)
+            _pending_query_embeddings[key] = future
+    try:
+        return future.result(timeout=max(timeout, 0))
+    except FutureTimeoutError:
+        return None
+    except Exception as e:
+        print(f"Query embedding failed: {str(e)}")
+        return None
+
+def keyword_candidates(conn, match, limit):
+    """Product ids of the best BM25 matches, best first."""
+    c = conn.cursor()
+    c.execute('''
+        SELECT p.id
+        FROM products_fts
+        JOIN products p ON p.rowid = products_fts.rowid
+        WHERE products_fts MATCH ? AND rank MATCH ?
+        ORDER BY rank
+        LIMIT ?
+    ''', (match, f"bm25({', '.join(str(weight) for weight in SEARCH_COLUMN_WEIGHTS)})", limit))
+    return [row[0] for row in c.fetchall()]
+
+def query_hybrid_page(conn, q, match, args):
+    """Return one page of hybrid results, the next cursor and whether semantic ranking was used."""
+    started = time.perf_counter()
+    limit = parse_page_size(args)
+    offset, use_semantic = 0, True
+    if args.get('cursor'):
+        cursor_values = decode_cursor(args.get('cursor'))
+        if len(cursor_values) != 2 or not isinstance(cursor_values[0], int):
+            raise ValueError('Invalid cursor')
+        # Later pages keep the ranking of the first one, even if the query embedding is ready by now
+        offset, use_semantic = cursor_values[0], bool(cursor_values[1])
+
+    keyword_ids = keyword_candidates(conn, match, HYBRID_CANDIDATES) if match else []
+
+    semantic_ids = []
+    if use_semantic:
+        remaining = HYBRID_SEARCH_BUDGET_MS / 1000 - (time.perf_counter() - started)
+        embedding = query_text_embedding(q, remaining)
+        if embedding is None:
+            use_semantic = False
+        else:
+            semantic_ids = [
+                product_id for product_id, similarity in product_vector_index.search(embedding, HYBRID_CANDIDATES)
+                if similarity >= HYBRID_MIN_SIMILARITY
+            ]
+
+    scores = {}
+    for weight, ranked_ids in ((1.0, keyword_ids), (HYBRID_SEMANTIC_WEIGHT, semantic_ids)):
+        for rank, product_id in enumerate(ranked_ids):
+            scores[product_id] = scores.get(product_id, 0.0) + weight / (HYBRID_RRF_K + rank + 1)
+    ranked = sorted(scores, key=lambda product_id: -scores[product_id])
+
+    # Apply the catalog filters to the fused candidates in one query
+    conditions, params = build_catalog_filters(args)
+    if conditions and ranked:
+        placeholders = ', '.join('?' for _ in ranked)
+        c = conn.cursor()
+        c.execute(f'''
+            SELECT p.id FROM products p
+            WHERE p.id IN ({placeholders}) AND {' AND '.join(conditions)}
+        ''', ranked + params)
+        allowed = {row[0] for row in c.fetchall()}
+        ranked = [product_id for product_id in ranked if product_id in allowed]
+
+    page_ids = ranked[offset:offset + limit]
+    products = fetch_products_by_ids(conn, page_ids)
+    for product in products:
+        product['score'] = scores[product['id']]
+    next_cursor = encode_cursor([offset + limit, int(use_semantic)]) if len(ranked) > offset + limit else None
+    return products, next_cursor, use_semantic
+
+@app.route('/api/search', methods=['GET'])
+def search_products():
+    """Keyword or hybrid (keyword + CLIP image similarity) product search with the /api/all-products filters and pagination"""
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'error': 'q is required'}), 400
+    mode = request.args.get('mode', 'keyword')
+    if mode not in SEARCH_MODES:
+        return jsonify({'error': f"mode must be one of: {', '.join(SEARCH_MODES)}"}), 400
+    try:
+        limit = parse_page_size(request.args)
+        match = build_search_match(q)
+        if mode == 'hybrid':
+            products, next_cursor, semantic = query_hybrid_page(get_db(), q, match, request.args)
+            return jsonify({'products': products, 'next_cursor': next_cursor, 'limit': limit, 'semantic': semantic})
+        if match is None:
+            return jsonify({'products': [], 'next_cursor': None, 'limit': limit})
+        products, next_cursor = query_search_page(get_db(), match, request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'products': products, 'next_cursor': next_cursor, 'limit': limit})
+
+def check_query_plans(conn):
+    """EXPLAIN the hot product queries; returns [(name, plan lines, ok)].
+
+    ok means no full table scan and no temp B-tree sort. A filtered query must also
+    seek on its filter instead of walking a whole products index; a category filter
+    may then sort the products it found through idx_product_categories_path.
+    """
+    queries = [
+        ('GET /api/products', SELLER_PRODUCTS_QUERY, [1], 'user_id=?'),
+        ('GET /api/all-products', ALL_PRODUCTS_QUERY, [], None),
+        ('POST /api/login', 'SELECT id, password_hash, role FROM users WHERE email = ?', ['user@user.com'], 'email=?'),
+    ]
+    for sort in CATALOG_SORTS:
+        for filters, seek in (({}, None), ({'seller': '1'}, 'user_id=?'), ({'category': 'Electronics'}, 'category_path'),
+                              ({'category': 'Electronics', 'seller': '1'}, 'category_path')):
+            for args in ({'sort': sort, **filters}, {'sort': sort, **filters, 'cursor': encode_cursor(['', ''])}):
+                sql, params, _ = build_catalog_query(MultiDict(args))
+                name = 'GET /api/all-products?' + '&'.join(f"{key}={'...' if key == 'cursor' else value}" for key, value in args.items())
+                queries.append((name, sql, params, seek))
+
+    results = []
+    for name, sql, params, seek in queries:
+        plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+        by_category = 'SCAN category_matches' in plan
+        full_scan = any(
+            detail.startswith('SCAN ') and (' USING ' not in detail or seek) and detail != 'SCAN category_matches'
+            for detail in plan
+        )
+        temp_sort = not by_category and any('USE TEMP B-TREE' in detail for detail in plan)
+        seeks = not seek or any(detail.startswith('SEARCH ') and seek in detail for detail in plan)
+        results.append((name, plan, seeks and not full_scan and not temp_sort))
+    return results
+
+def parse_similarity_limit():
+    try:
+        return max(1, min(int(request.args.get('k', 12)), 100))
+    except ValueError:
+        return 12
+
+@app.route('/api/products/<product_id>/similar', methods=['GET'])
+def get_similar_products(product_id):
+    """Return products whose images look most like the given product's image"""
+    k = parse_similarity_limit()
+    embedding = product_vector_index.get(product_id)
+    if embedding is None:
+        return jsonify({'error': 'No image embedding for this product'}), 404
+
+    matches = product_vector_index.search(embedding, k, exclude={product_id})
+    conn = get_db()
+    products = fetch_products_by_ids(conn, [match_id for match_id, _ in matches])
+
+    scores = dict(matches)
+    for product in products:
+        product['similarity'] = scores[product['id']]
+    return jsonify({'product_id': product_id, 'products': products})
+
+@app.route('/api/search/image', methods=['POST'])
+def search_by_image():
+    """Find catalog products that look like an uploaded image"""
+    if 'image' not in request.files or request.files['image'].filename == '':
+        return jsonify({'error': 'No image uploaded'}), 400
+
+    k = parse_similarity_limit()
+    try:
+        embedding = image_embedding_for_upload(inspect_image_upload(request.files['image']))
+    except HTTPException:
+        raise
+    except ImageTooLargeError as e:
+        return jsonify({'error': str(e)}), 413
+    except Exception as e:
+        return jsonify({'error': f'Invalid image file: {str(e)}'}), 400
+
+    matches = product_vector_index.search(embedding, k)
+    conn = get_db()
+    products = fetch_products_by_ids(conn, [match_id for match_id, _ in matches])
+
+    scores = dict(matches)
+    for product in products:
+        product['similarity'] = scores[product['id']]
+    return jsonify({'products': products})
+
+@app.route('/')
+def home():
+    return jsonify({'message': 'AI Product Categorizer API is running!'})
+
+class GoogleGeminiBackend:
+    """google.generativeai behind the small interface GeminiClient uses."""
+
+    name = 'google'
+
+    def configure(self, api_key):
+        genai.configure(api_key=api_key)
+
+    def list_models(self):
+        return [{
+            'name': model.name,
+            'display_name': model.display_name,
+            'description': model.description,
+            'supported_generation_methods': list(model.supported_generation_methods)
+        } for model in genai.list_models()]
+
+    def generate(self, model_name, parts):
+        response = genai.GenerativeModel(model_name).generate_content(parts)
+        return response.text if response else ''
+
+class FakeGeminiBackend:
+    """Local stand-in for Gemini (GEMINI_BACKEND=fake) for tests and offline development.
+
+    It lists the configured candidate models and answers every prompt with a
+    deterministic description built from the product name in the prompt, so no
+    API key or network access is needed. `latency` (seconds) and `error_rate`
+    inject slow calls and retryable 503 errors to exercise GeminiClient's
+    retries and circuit breaker.
+    """
+
+    name = 'fake'
+
+    def __init__(self, model_names=None, latency=0.0, error_rate=0.0):
+        self.model_names = model_names or GEMINI_MODELS
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+
+    def configure(self, api_key):
+        pass
+
+    def list_models(self):
+        return [{
+            'name': f"models/{model_name}",
+            'display_name': f"{model_name} (fake)",
+            'description': 'Local fake Gemini model',
+            'supported_generation_methods': ['generateContent']
+        } for model_name in self.model_names]
+
+    def generate(self, model_name, parts):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            raise google_exceptions.ServiceUnavailable('Injected fake Gemini failure')
+        prompt = next((part for part in parts if isinstance(part, str)), '')
+        match = re.search(r'^Product Name: (.*)$', prompt, re.MULTILINE)
+        product_name = match.group(1).strip() if match else 'this product'
+        return f"{product_name} combines a clean design with dependable everyday quality."
+
+class GeminiUnavailableError(RuntimeError):
+    """Gemini was not called: the circuit is open, all call slots are busy or the deadline has passed."""
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    After `threshold` failures in a row the circuit opens and calls are refused
+    for `reset_seconds`; then one trial call is let through (half-open), which
+    closes the circuit on success or reopens it on failure.
+    """
+
+    def __init__(self, threshold, reset_seconds):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._times_opened = 0
+
+    def allow(self):
+        """Whether a call may go ahead now."""
+        with self._lock:
+            if self._state == 'closed':
+                return True
+            if self._state == 'open' and time.time() - self._opened_at >= self.reset_seconds:
+                self._state = 'half_open'
+                self._trial_running = False
+            if self._state == 'half_open' and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = 'closed'
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._state == 'half_open' or self._failures >= self.threshold:
+                if self._state != 'open':
+                    self._times_opened += 1
+                    print(f"Circuit opened after {self._failures} consecutive failures")
+                self._state = 'open'
+                self._opened_at = time.time()
+
+    def release_trial(self):
+        """Give up a half-open trial slot without a verdict (the call never reached the upstream)."""
+        with self._lock:
+            self._trial_running = False
+
+    def status(self):
+        with self._lock:
+            retry_in = None
+            if self._state == 'open':
+                retry_in = round(max(0.0, self.reset_seconds - (time.time() - self._opened_at)), 1)
+            return {
+                'state': self._state,
+                'consecutive_failures': self._failures,
+                'threshold': self.threshold,
+                'retry_in_seconds': retry_in,
+                'times_opened': self._times_opened
+            }
+
+# Errors worth retrying: rate limits, overload and transient transport failures
+GEMINI_RETRYABLE_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+    ConnectionError,
+    TimeoutError,
+)
+
+class GeminiClient:
+    """Long-lived Gemini client shared by all requests.
+
+    The API key is configured once, and the first model in GEMINI_MODELS that the
+    account can call generateContent on is resolved once through list_models and
+    cached for GEMINI_MODEL_TTL seconds. A failed generation drops the cached
+    model so the next attempt resolves it again. Diagnostics read the cached state
+    instead of calling the API.
+
+    Generation is guarded so a slow or failing upstream cannot tie up the server:
+    at most `max_concurrency` calls are in flight (a call that outlives its
+    caller's deadline keeps its slot until it returns), every call has a
+    deadline, retryable errors are retried with full-jitter exponential backoff
+    inside that deadline, and a circuit breaker refuses calls outright while
+    Gemini keeps failing so callers go straight to their fallback.
+    """
+
+    def __init__(self, backend, api_key, model_names, ttl, max_concurrency=GEMINI_MAX_CONCURRENCY,
+                 deadline=GEMINI_DEADLINE_SECONDS, max_retries=GEMINI_MAX_RETRIES, retry_base=GEMINI_RETRY_BASE_SECONDS,
+                 breaker=None):
+        self.backend = backend
+        self.api_key = api_key
+        self.model_names = model_names
+        self.ttl = ttl
+        self.max_concurrency = max_concurrency
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.breaker = breaker or CircuitBreaker(GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_RESET_SECONDS)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._calls = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='gemini')
+        self._in_flight = 0
+        self._retries = 0
+        self._rejected = 0
+        self._timeouts = 0
+        self._lock = threading.Lock()
+        self._configured = False
+        self._model = None
+        self._resolved_at = None
+        self._available_models = None
+        self._last_error = None
+        self._last_success_at = None
+
+    def is_configured(self):
+        """Whether a real key is set (the fake backend needs none)."""
+        return self.backend.name == 'fake' or bool(self.api_key and self.api_key != 'your_gemini_api_key_here')
+
+    def _configure(self):
+        if not self._configured:
+            self.backend.configure(self.api_key)
+            self._configured = True
+
+    def _model_is_fresh(self):
+        return self._model is not None and time.time() - self._resolved_at < self.ttl
+
+    def resolve_model(self, force=False, timeout=None):
+        """Return the cached model name, resolving it when missing, expired or forced.
+
+        Listing models is an upstream call like any other: it takes a concurrency
+        slot and gives up after `timeout` seconds (default: the client's deadline).
+        """
+        with self._lock:
+            if not force and self._model_is_fresh():
+                return self._model
+            self._configure()
+        try:
+            available_models = self._call(self.backend.list_models, timeout=self.deadline if timeout is None else timeout)
+        except Exception as e:
+            self._last_error = f"Could not list Gemini models: {str(e)}"
+            raise
+        callable_models = {
+            model['name'] for model in available_models
+            if 'generateContent' in model['supported_generation_methods']
+        }
+        with self._lock:
+            self._available_models = available_models
+            for model_name in self.model_names:
+                full_name = model_name if model_name.startswith('models/') else f"models/{model_name}"
+                if full_name in callable_models:
+                    if self._model != full_name:
+                        print(f"Resolved Gemini model: {full_name}")
+                    self._model = full_name
+                    self._resolved_at = time.time()
+                    return full_name
+            self._model = None
+            self._last_error = f"None of {', '.join(self.model_names)} is available"
+            raise RuntimeError(self._last_error)
+
+    def invalidate(self):
+        """Forget the resolved model so the next call resolves it again."""
+        with self._lock:
+            self._model = None
+            self._resolved_at = None
+
+    def _release_slot(self, future):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _call(self, func, *args, timeout):
+        """Run one upstream call in a concurrency slot, abandoned (not cancelled) after timeout seconds."""
+        if not self._slots.acquire(timeout=max(0.0, timeout)):
+            with self._lock:
+                self._rejected += 1
+            raise GeminiUnavailableError(f'All {self.max_concurrency} Gemini call slots are busy')
+        with self._lock:
+            self._in_flight += 1
+        future = self._calls.submit(func, *args)
+        future.add_done_callback(self._release_slot)
+        try:
+            return future.result(timeout=max(0.0, timeout))
+        except FutureTimeoutError:
+            with self._lock:
+                self._timeouts += 1
+            raise TimeoutError(f'Gemini did not answer within the {self.deadline:g}s deadline')
+
+    def generate(self, parts, deadline=None):
+        """Generate text with the resolved model and return it stripped.
+
+        `deadline` is an absolute time.time() by which to give up (default: now +
+        self.deadline). Raises GeminiUnavailableError without calling Gemini while
+        the circuit is open or no call slot frees up in time.
+        """
+        if not self.is_configured():
+            raise RuntimeError('Gemini API key not configured')
+        deadline = deadline or time.time() + self.deadline
+        if not self.breaker.allow():
+            with self._lock:
+                self._rejected += 1
+            raise GeminiUnavailableError('Gemini circuit is open after repeated failures')
+        attempt = 0
+        while True:
+            try:
+                model_name = self.resolve_model(timeout=deadline - time.time())
+                text = self._call(self.backend.generate, model_name, parts, timeout=deadline - time.time())
+            except GeminiUnavailableError:
+                self.breaker.release_trial()
+                raise
+            except GEMINI_RETRYABLE_ERRORS as e:
+                self._last_error = str(e)
+                # Full jitter keeps retries from many workers from arriving together
+                delay = random.uniform(0, self.retry_base * 2 ** attempt)
+                if attempt >= self.max_retries or time.time() + delay >= deadline:
+                    self.breaker.record_failure()
+                    raise
+                attempt += 1
+                with self._lock:
+                    self._retries += 1
+                print(f"Gemini call failed ({str(e)}), retry {attempt} in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            except Exception as e:
+                # Not an upstream health problem (bad request, unknown model): neutral for the
+                # breaker, but re-resolve the model next time
+                self._last_error = str(e)
+                self.breaker.release_trial()
+                self.invalidate()
+                raise
+            break
+        self.breaker.record_success()
+        if not text or not text.strip():
+            self._last_error = 'Empty response from Gemini'
+            raise RuntimeError(self._last_error)
+        self._last_success_at = time.time()
+        self._last_error = None
+        return text.strip()
+
+    def available_models(self):
+        """Models seen at the last resolution, listing them once if there was none yet."""
+        if self._available_models is None:
+            self.resolve_model()
+        return self._available_models
+
+    def status(self):
+        """Cached client state for the diagnostics endpoints; never calls the API."""
+        fresh = self._model_is_fresh()
+        return {
+            'backend': self.backend.name,
+            'configured': self.is_configured(),
+            'model': self._model if fresh else None,
+            'candidates': self.model_names,
+            'resolved_seconds_ago': round(time.time() - self._resolved_at, 1) if fresh else None,
+            'model_ttl': self.ttl,
+            'last_success_seconds_ago': round(time.time() - self._last_success_at, 1) if self._last_success_at else None,
+            'last_error': self._last_error,
+            'circuit': self.breaker.status(),
+            'in_flight': self._in_flight,
+            'max_concurrency': self.max_concurrency,
+            'deadline_seconds': self.deadline,
+            'retries': self._retries,
+            'rejected': self._rejected,
+            'timeouts': self._timeouts
+        }
+
+gemini_client = GeminiClient(
+    FakeGeminiBackend(latency=GEMINI_FAKE_LATENCY_MS / 1000, error_rate=GEMINI_FAKE_ERROR_RATE)
+    if GEMINI_BACKEND == 'fake' else GoogleGeminiBackend(),
+    GEMINI_API_KEY, GEMINI_MODELS, GEMINI_MODEL_TTL
+)
+
+def extract_info_from_product_name(product_name):
+    """Extract useful information from product name"""
+    name_lower = product_name.lower()
+    
+    # Extract brand if mentioned
+    brands = ['apple', 'samsung', 'nike', 'adidas', 'sony', 'lg', 'hp', 'dell', 'canon', 'nikon']
+    brand = next((b for b in brands if b in name_lower), None)
+    
+    # Extract colors
+    colors = ['black', 'white', 'red', 'blue', 'green', 'yellow', 'pink', 'purple', 'gray', 'grey', 'silver', 'gold']
+    color = next((c for c in colors if c in name_lower), None)
+    
+    # Extract sizes
+    sizes = ['xs', 'small', 'medium', 'large', 'xl', 'xxl', '32gb', '64gb', '128gb', '256gb', '512gb', '1tb']
+    size = next((s for s in sizes if s in name_lower), None)
+    
+    # Extract materials
+    materials = ['cotton', 'silk', 'leather', 'plastic', 'metal', 'wood', 'glass', 'ceramic']
+    material = next((m for m in materials if m in name_lower), None)
+    
+    return {
+        'brand': brand,
+        'color': color, 
+        'size': size,
+        'material': material,
+        'original_name': product_name
+    }
+
+def generate_product_description_with_name_and_image(product_name, category_names, image_path=None):
+    """Generate description with optional image analysis using Gemini Vision"""
+    print(f"Generating description with image path: {image_path}")
+    print(f"Gemini configured: {gemini_client.is_configured()}")
+    
     # Extract info from product name
     name_info = extract_info_from_product_name(product_name)
     print(f"Name info extracted: {name_info}")
@@ -967,10 +3426,10 @@ def generate_product_description_with_name_and_image(product_name, category_name
     if image_path and os.path.exists(image_path):
         print(f"Image exists at: {image_path}")
         
-        if GEMINI_API_KEY and GEMINI_API_KEY != 'your_gemini_api_key_here':
+        if gemini_client.is_configured():
             try:
                 print("Attempting Gemini Vision...")
-                return generate_description_with_gemini_vision(image_path, product_name, category_names)
+                return try_gemini_vision(prepare_gemini_image(image_path), product_name, category_names)
             except Exception as e:
                 print(f"Gemini Vision failed: {e}")
     else:
@@ -1047,69 +3506,105 @@ def create_basic_description(product_name, category_names, name_info):
     
     return description
 
-@app.route('/api/generate-description', methods=['POST'])
-def generate_description_endpoint():
-    """Separate endpoint for generating product descriptions"""
-    print("\n=== Starting Description Generation Request ===")
+def parse_description_request(data):
+    """Validate a description request body; returns (arguments, None) or (None, error message)."""
+    data = data or {}
+    categories = data.get('categories', [])
+    product_name = (data.get('product_name') or '').strip()
     
-    try:
-        data = request.get_json()
-        categories = data.get('categories', [])
-        product_name = data.get('product_name', '').strip()
-        image_data = data.get('image_data', '')
-        
-        print(f"Product Name: {product_name}")
-        print(f"Categories: {categories}")
-        print(f"Image data provided: {bool(image_data)}")
-        
-        if not categories:
-            print("Error: No categories provided")
-            return jsonify({'error': 'No categories provided'}), 400
-            
-        if not product_name:
-            print("Error: No product name provided")
-            return jsonify({'error': 'Product name is required'}), 400
+    print(f"Product Name: {product_name}")
+    print(f"Categories: {categories}")
+    print(f"Image provided: {bool(data.get('image_data') or data.get('image_hash') or data.get('image_url'))}")
+    
+    if not categories:
+        print("Error: No categories provided")
+        return None, 'No categories provided'
         
-        # Extract category names
-        category_names = []
-        for cat in categories:
-            if isinstance(cat, dict):
-                category_names.append(cat.get('name', '').split(' - ')[-1])
+    if not product_name:
+        print("Error: No product name provided")
+        return None, 'Product name is required'
+    
+    # Extract category names
+    category_names = []
+    for cat in categories:
+        if isinstance(cat, dict):
+            category_names.append(cat.get('name', '').split(' - ')[-1])
+        else:
+            category_names.append(str(cat).split(' - ')[-1])
+    
+    print(f"Extracted category names: {category_names}")
+    
+    image_hash, image_source, error = resolve_description_image(data)
+    if error:
+        return None, error
+    return {
+        'product_name': product_name,
+        'category_names': category_names,
+        'image_hash': image_hash,
+        'image_source': image_source,
+        # Sellers asking for a fresh text skip the cached one (the new text replaces it)
+        'regenerate': bool(data.get('regenerate', False))
+    }, None
+
+def generate_description(product_name, category_names, image_hash=None, image_source=None, regenerate=False):
+    """Describe a product with Gemini Vision when an image is given, else from a template."""
+    description = None
+    vision_analysis_used = False
+    cached = False
+    
+    # Try Gemini Vision if image is provided and API key is available
+    if image_hash and gemini_client.is_configured():
+        try:
+            cache_key = description_cache_key(image_hash, product_name, category_names)
+            entry = None if regenerate else description_cache.get(cache_key)
+            if entry:
+                description = entry['description']
+                vision_analysis_used = True
+                cached = True
+                print("Using cached Gemini Vision description")
             else:
-                category_names.append(str(cat).split(' - ')[-1])
-        
-        print(f"Extracted category names: {category_names}")
-        
-        # Try Gemini Vision if image is provided and API key is available
-        description = None
-        vision_analysis_used = False
-        
-        if image_data and GEMINI_API_KEY and GEMINI_API_KEY != 'your_gemini_api_key_here':
-            try:
                 print("Attempting Gemini Vision...")
-                description = try_gemini_vision(image_data, product_name, category_names)
+                description = try_gemini_vision(gemini_image_for(image_hash, image_source), product_name, category_names)
                 if description:
                     vision_analysis_used = True
+                    description_cache.set(cache_key, {'description': description})
                     print("Success: Generated description with Gemini Vision")
-            except Exception as e:
-                print(f"Gemini Vision failed: {str(e)}")
-                description = None
-        
-        # If Gemini didn't work, use enhanced basic description
-        if not description:
-            print("Using enhanced basic description generation...")
-            description = create_basic_description(product_name, category_names, extract_info_from_product_name(product_name))
-        
-        print(f"Generated description: {description[:100]}...")
+        except Exception as e:
+            print(f"Gemini Vision failed: {str(e)}")
+            description = None
+    
+    # If Gemini didn't work, use enhanced basic description
+    if not description:
+        print("Using enhanced basic description generation...")
+        description = create_basic_description(product_name, category_names, extract_info_from_product_name(product_name))
+    
+    print(f"Generated description: {description[:100]}...")
+    return {
+        'description': description,
+        'categories_used': category_names,
+        'product_name_used': product_name,
+        'vision_analysis_used': vision_analysis_used,
+        'cached': cached,
+        # Send this back as image_hash instead of image_data to regenerate
+        'image_hash': image_hash
+    }
+
+@app.route('/api/generate-description', methods=['POST'])
+def generate_description_endpoint():
+    """Generate a product description while the request waits (see the jobs endpoint for the non-blocking form)"""
+    print("\n=== Starting Description Generation Request ===")
+    
+    try:
+        arguments, error = parse_description_request(request.get_json())
+        if error:
+            return jsonify({'error': error}), 400
         
+        result = generate_description(**arguments)
         print("\n=== Description Generation Completed ===")
-        return jsonify({
-            'description': description,
-            'categories_used': category_names,
-            'product_name_used': product_name,
-            'vision_analysis_used': vision_analysis_used
-        })
+        return jsonify(result)
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"\n!!! Error in generate_description_endpoint !!!")
         print(f"Error details: {str(e)}")
@@ -1117,53 +3612,330 @@ def generate_description_endpoint():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
-def try_gemini_vision(image_data, product_name, category_names):
-    """Simple Gemini Vision function with minimal error handling"""
+class JobLimitError(Exception):
+    """Raised when a job cannot be queued; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+class InProcessJobQueue:
+    """Background jobs run on a bounded thread pool in this process.
+
+    Each owner (user or client address) may have at most `per_owner_limit` jobs
+    queued or running, and at most `max_pending` jobs wait in total, so a burst of
+    slow Gemini calls cannot take over the request workers. Job state is kept in
+    memory and finished jobs are forgotten after `result_ttl` seconds, which means
+    jobs do not survive a restart and are only visible to the worker that ran
+    them. Waiters block on a condition that is notified on every state change.
+    """
+
+    name = 'inprocess'
+
+    def __init__(self, workers, per_owner_limit, max_pending, result_ttl):
+        self.per_owner_limit = per_owner_limit
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='jobs')
+        self._workers = workers
+        self._jobs = {}
+        self._changed = threading.Condition()
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    def _prune(self):
+        cutoff = time.time() - self.result_ttl
+        for job_id in [job_id for job_id, job in self._jobs.items() if job['finished_at'] and job['finished_at'] < cutoff]:
+            del self._jobs[job_id]
+
+    def submit(self, owner, kind, func, **arguments):
+        """Queue func(**arguments) and return the new job's snapshot; raises JobLimitError when full."""
+        with self._changed:
+            self._prune()
+            active = [job for job in self._jobs.values() if job['status'] in ('queued', 'running')]
+            if sum(1 for job in active if job['owner'] == owner) >= self.per_owner_limit:
+                self._rejected += 1
+                raise JobLimitError(f'At most {self.per_owner_limit} jobs may run at once per user', 429)
+            if len(active) >= self.max_pending:
+                self._rejected += 1
+                raise JobLimitError('Job queue is full, try again shortly', 503)
+            job = {
+                'id': uuid.uuid4().hex,
+                'kind': kind,
+                'owner': owner,
+                'status': 'queued',
+                'result': None,
+                'error': None,
+                'created_at': time.time(),
+                'started_at': None,
+                'finished_at': None
+            }
+            self._jobs[job['id']] = job
+            snapshot = self._snapshot(job)
+        self._executor.submit(self._run, job, func, arguments)
+        return snapshot
+
+    def _update(self, job, **changes):
+        with self._changed:
+            job.update(changes)
+            self._changed.notify_all()
+
+    def _run(self, job, func, arguments):
+        self._update(job, status='running', started_at=time.time())
+        try:
+            result = func(**arguments)
+        except Exception as e:
+            print(f"Job {job['id']} ({job['kind']}) failed: {str(e)}")
+            self._failed += 1
+            self._update(job, status='failed', error=str(e), finished_at=time.time())
+            return
+        self._completed += 1
+        self._update(job, status='done', result=result, finished_at=time.time())
+
+    def _snapshot(self, job):
+        snapshot = {key: value for key, value in job.items() if key != 'owner'}
+        if job['status'] == 'queued':
+            snapshot['position'] = sum(
+                1 for other in self._jobs.values()
+                if other['status'] == 'queued' and other['created_at'] <= job['created_at']
+            )
+        return snapshot
+
+    def get(self, job_id):
+        """Current snapshot of a job, or None if it is unknown or expired."""
+        with self._changed:
+            job = self._jobs.get(job_id)
+            return self._snapshot(job) if job else None
+
+    def wait(self, job_id, known_status, timeout):
+        """Block until the job's status differs from known_status (or timeout) and return its snapshot."""
+        with self._changed:
+            self._changed.wait_for(
+                lambda: job_id not in self._jobs or self._jobs[job_id]['status'] != known_status, timeout
+            )
+            job = self._jobs.get(job_id)
+            return self._snapshot(job) if job else None
+
+    def metrics(self):
+        with self._changed:
+            statuses = [job['status'] for job in self._jobs.values()]
+        return {
+            'backend': self.name,
+            'workers': self._workers,
+            'per_owner_limit': self.per_owner_limit,
+            'queued': statuses.count('queued'),
+            'running': statuses.count('running'),
+            'completed': self._completed,
+            'failed': self._failed,
+            'rejected': self._rejected
+        }
+
+class SQLiteJobQueue(InProcessJobQueue):
+    """Like InProcessJobQueue, but job state lives in the jobs table of the shared database.
+
+    Jobs still run on this process's thread pool, but any worker can report them,
+    so a poll that lands on another process finds the job, and the per-owner and
+    total limits count the jobs of every worker. Waiters on other processes poll
+    the table every POLL_INTERVAL seconds. A job still queued or running after
+    `result_ttl` seconds belonged to a worker that died; it is marked failed.
+    """
+
+    name = 'sqlite'
+    POLL_INTERVAL = 0.5
+    COLUMNS = ('id', 'kind', 'owner', 'status', 'result', 'error', 'created_at', 'started_at', 'finished_at')
+
+    def _row_to_job(self, row):
+        job = dict(zip(self.COLUMNS, row))
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+    def _expire(self, conn):
+        cutoff = time.time() - self.result_ttl
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = 'Job was lost', finished_at = ? WHERE status IN ('queued', 'running') AND created_at < ?",
+            (time.time(), cutoff)
+        )
+        conn.execute('DELETE FROM jobs WHERE finished_at < ?', (cutoff,))
+
+    def submit(self, owner, kind, func, **arguments):
+        """Queue func(**arguments) and return the new job's snapshot; raises JobLimitError when full."""
+        conn = connect_db()
+        try:
+            # The write lock makes the limit checks and the insert atomic across workers
+            conn.execute('BEGIN IMMEDIATE')
+            self._expire(conn)
+            active = conn.execute(
+                "SELECT COUNT(*), SUM(owner = ?) FROM jobs WHERE status IN ('queued', 'running')", (owner,)
+            ).fetchone()
+            if (active[1] or 0) >= self.per_owner_limit:
+                conn.rollback()
+                self._rejected += 1
+                raise JobLimitError(f'At most {self.per_owner_limit} jobs may run at once per user', 429)
+            if active[0] >= self.max_pending:
+                conn.rollback()
+                self._rejected += 1
+                raise JobLimitError('Job queue is full, try again shortly', 503)
+            job = {
+                'id': uuid.uuid4().hex,
+                'kind': kind,
+                'owner': owner,
+                'status': 'queued',
+                'result': None,
+                'error': None,
+                'created_at': time.time(),
+                'started_at': None,
+                'finished_at': None
+            }
+            conn.execute(
+                f"INSERT INTO jobs ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' for _ in self.COLUMNS)})",
+                [job[column] for column in self.COLUMNS]
+            )
+            conn.commit()
+            snapshot = self._snapshot_from(conn, job)
+        finally:
+            conn.close()
+        self._executor.submit(self._run, job, func, arguments)
+        return snapshot
+
+    def _update(self, job, **changes):
+        job.update(changes)
+        if 'result' in changes:
+            changes['result'] = json.dumps(changes['result'])
+        conn = connect_db()
+        try:
+            conn.execute(
+                f"UPDATE jobs SET {', '.join(f'{column} = ?' for column in changes)} WHERE id = ?",
+                list(changes.values()) + [job['id']]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        with self._changed:
+            self._changed.notify_all()
+
+    def _snapshot_from(self, conn, job):
+        snapshot = {key: value for key, value in job.items() if key != 'owner'}
+        if job['status'] == 'queued':
+            snapshot['position'] = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at <= ?", (job['created_at'],)
+            ).fetchone()[0]
+        return snapshot
+
+    def get(self, job_id):
+        """Current snapshot of a job, or None if it is unknown or expired."""
+        conn = connect_db()
+        try:
+            row = conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if not row:
+                return None
+            job = self._row_to_job(row)
+            # A job past its TTL is reported the way the next _expire will store it
+            if job['status'] in ('queued', 'running') and job['created_at'] < time.time() - self.result_ttl:
+                job.update(status='failed', error='Job was lost', finished_at=time.time())
+            return self._snapshot_from(conn, job)
+        finally:
+            conn.close()
+
+    def wait(self, job_id, known_status, timeout):
+        """Block until the job's status differs from known_status (or timeout) and return its snapshot."""
+        deadline = time.time() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.time()
+            if not job or job['status'] != known_status or remaining <= 0:
+                return job
+            # Jobs run here notify right away; others are seen at the next poll
+            with self._changed:
+                self._changed.wait(min(self.POLL_INTERVAL, remaining))
+
+    def metrics(self):
+        conn = connect_db()
+        try:
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY status"
+            ).fetchall())
+        finally:
+            conn.close()
+        return {
+            'backend': self.name,
+            'workers': self._workers,
+            'per_owner_limit': self.per_owner_limit,
+            'queued': counts.get('queued', 0),
+            'running': counts.get('running', 0),
+            'completed': self._completed,
+            'failed': self._failed,
+            'rejected': self._rejected
+        }
+
+# Description jobs: JOB_QUEUE_BACKEND picks the implementation. 'sqlite' shares job state
+# between worker processes through the database; 'inprocess' keeps it in this process only
+JOB_QUEUE_BACKENDS = {'sqlite': SQLiteJobQueue, 'inprocess': InProcessJobQueue}
+JOB_QUEUE_BACKEND = os.getenv('JOB_QUEUE_BACKEND', 'sqlite')
+DESCRIPTION_JOB_WORKERS = int(os.getenv('DESCRIPTION_JOB_WORKERS', '4'))
+JOBS_PER_USER = int(os.getenv('JOBS_PER_USER', '2'))
+JOB_QUEUE_MAX_PENDING = int(os.getenv('JOB_QUEUE_MAX_PENDING', '100'))
+JOB_RESULT_TTL = float(os.getenv('JOB_RESULT_TTL', '600'))
+JOB_EVENTS_TIMEOUT = 120  # seconds an event stream stays open
+if JOB_QUEUE_BACKEND not in JOB_QUEUE_BACKENDS:
+    raise ValueError(f"Unknown JOB_QUEUE_BACKEND '{JOB_QUEUE_BACKEND}', expected one of {', '.join(JOB_QUEUE_BACKENDS)}")
+job_queue = JOB_QUEUE_BACKENDS[JOB_QUEUE_BACKEND](DESCRIPTION_JOB_WORKERS, JOBS_PER_USER, JOB_QUEUE_MAX_PENDING, JOB_RESULT_TTL)
+
+def job_owner():
+    """Who a job counts against for per-user limits: the logged-in user, else the client address."""
+    payload = get_jwt_payload()
+    if payload and payload.get('user_id'):
+        return f"user:{payload['user_id']}"
+    return f"ip:{request.remote_addr}"
+
+@app.route('/api/generate-description/jobs', methods=['POST'])
+def submit_description_job():
+    """Queue description generation and return the job id right away"""
+    arguments, error = parse_description_request(request.get_json(silent=True))
+    if error:
+        return jsonify({'error': error}), 400
     try:
-        # Configure Gemini
-        genai.configure(api_key=GEMINI_API_KEY)
-        
-        # Try different model names (updated for current API)
-        model = None
-        model_names = [
-            'gemini-1.5-flash',
-            'gemini-1.5-pro', 
-            'models/gemini-1.5-flash',
-            'models/gemini-1.5-pro'
-        ]
-        
-        for model_name in model_names:
-            try:
-                model = genai.GenerativeModel(model_name)
-                print(f"Successfully initialized model: {model_name}")
-                break
-            except Exception as e:
-                print(f"Failed to initialize {model_name}: {str(e)}")
-                continue
-        
-        if not model:
-            raise Exception("Could not initialize any Gemini model")
-        
-        # Process image data
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
-        
-        image_bytes = base64.b64decode(image_data)
-        
-        # Save temporarily
-        timestamp = str(int(time.time() * 1000))
-        temp_filename = f"temp_gemini_{timestamp}.jpg"
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], temp_filename)
-        
-        with open(image_path, 'wb') as f:
-            f.write(image_bytes)
-        
-        # Load image
-        img = Image.open(image_path)
-        
-        # Create a simple but effective prompt
-        categories_text = ', '.join(category_names)
-        prompt = f"""Look at this product image and create a professional product description.
+        job = job_queue.submit(job_owner(), 'description', generate_description, **arguments)
+    except JobLimitError as e:
+        return jsonify({'error': str(e)}), e.status
+    job['status_url'] = f"/api/jobs/{job['id']}"
+    job['events_url'] = f"/api/jobs/{job['id']}/events"
+    return jsonify(job), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Poll a job; the id is unguessable, so knowing it is enough to read the result"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-sent events with the job's status on every change, ending when it finishes"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def stream(job):
+        deadline = time.time() + JOB_EVENTS_TIMEOUT
+        status = None
+        while True:
+            if job['status'] != status:
+                status = job['status']
+                yield f"event: {status}\ndata: {json.dumps(job)}\n\n"
+            else:
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+            if status in ('done', 'failed') or time.time() >= deadline:
+                return
+            job = job_queue.wait(job_id, status, min(15, deadline - time.time()))
+            if not job:
+                return
+
+    return Response(stream(job), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+GEMINI_DESCRIPTION_PROMPT = """Look at this product image and create a professional product description.
 
 Product Name: {product_name}
 Categories: {categories_text}
@@ -1174,20 +3946,106 @@ Write a compelling 60-80 word description that includes:
 - Professional e-commerce language
 
 Description:"""
+# Part of every description cache key, so editing the prompt retires old cached texts
+DESCRIPTION_PROMPT_VERSION = hashlib.sha256(GEMINI_DESCRIPTION_PROMPT.encode('utf-8')).hexdigest()[:16]
 
-        # Generate content
-        response = model.generate_content([prompt, img])
-        
-        # Clean up temp file
-        try:
-            os.remove(image_path)
-        except:
-            pass
-        
-        if response and response.text:
-            return response.text.strip()
+def decode_image_data(image_data):
+    """Bytes of a base64 image, with or without a data: URL prefix."""
+    if ',' in image_data:
+        image_data = image_data.split(',')[1]
+    return base64.b64decode(image_data)
+
+def description_cache_key(image_hash, product_name, category_names):
+    """Cache key for a vision description: image hash, normalized name and categories, prompt version."""
+    normalized_name = ' '.join(product_name.lower().split())
+    normalized_categories = [' '.join(name.lower().split()) for name in category_names]
+    key_source = json.dumps([image_hash, normalized_name, normalized_categories, DESCRIPTION_PROMPT_VERSION])
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+def prepare_gemini_image(source):
+    """Decode an image (bytes or a path) and return it as a compact JPEG no larger than GEMINI_IMAGE_MAX_SIDE.
+
+    Gemini downsamples large images anyway, so full-resolution uploads only cost
+    bandwidth and latency. JPEGs are decoded in draft mode at a reduced scale and
+    transparent images are flattened onto white.
+    """
+    with Image.open(BytesIO(source) if isinstance(source, bytes) else source) as original:
+        width, height = original.size
+        if width * height > MAX_IMAGE_PIXELS:
+            raise ImageTooLargeError(f"Image is {width}x{height}, limit is {MAX_IMAGE_PIXELS} pixels")
+        original.draft('RGB', (GEMINI_IMAGE_MAX_SIDE, GEMINI_IMAGE_MAX_SIDE))
+        image = ImageOps.exif_transpose(original)
+        if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
         else:
-            raise Exception("Empty response from Gemini")
+            image = image.convert('RGB')
+    image.thumbnail((GEMINI_IMAGE_MAX_SIDE, GEMINI_IMAGE_MAX_SIDE), Image.LANCZOS, reducing_gap=3.0)
+    output = BytesIO()
+    image.save(output, 'JPEG', quality=GEMINI_IMAGE_QUALITY, optimize=True)
+    return output.getvalue()
+
+def gemini_image_for(image_hash, source=None):
+    """The prepared JPEG for an image hash, from the cache or prepared from source (bytes or a path)."""
+    cached = gemini_image_cache.get(image_hash)
+    if cached:
+        return base64.b64decode(cached)
+    image = prepare_gemini_image(source)
+    gemini_image_cache.set(image_hash, base64.b64encode(image).decode('ascii'))
+    return image
+
+def resolve_description_image(data):
+    """Find the image a description request refers to.
+
+    Accepts `image_data` (base64, optionally a data: URL), `image_hash` (the hash
+    returned by an earlier description or upload) or `image_url` (an /uploads/ URL).
+    Returns (image_hash, source, error); source is the image bytes or a file path.
+    """
+    image_data = data.get('image_data')
+    if image_data:
+        if not isinstance(image_data, str):
+            return None, None, 'image_data must be a base64 string'
+        try:
+            image_bytes = decode_image_data(image_data)
+        except Exception:
+            return None, None, 'image_data is not valid base64'
+        return hashlib.sha256(image_bytes).hexdigest(), image_bytes, None
+
+    image_hash = data.get('image_hash')
+    image_url = data.get('image_url')
+    if not image_hash and not image_url:
+        return None, None, None
+    if not isinstance(image_hash or '', str) or not isinstance(image_url or '', str):
+        return None, None, 'image_hash and image_url must be strings'
+
+    conn = get_db()
+    if image_hash:
+        image_hash = str(image_hash).lower()
+        prepared = gemini_image_cache.get(image_hash)
+        if prepared:
+            # Passed along in case the entry is evicted before the job runs
+            return image_hash, base64.b64decode(prepared), None
+        blob_path = existing_blob_path(conn, image_hash)
+        if not blob_path:
+            return None, None, 'Unknown image_hash, send image_data instead'
+        return image_hash, os.path.join(app.config['UPLOAD_FOLDER'], blob_path), None
+
+    path = upload_path(image_url)
+    row = conn.execute('SELECT hash FROM blobs WHERE path = ?', (image_url[len('/uploads/'):],)).fetchone() if path else None
+    if not row or not os.path.exists(path):
+        return None, None, 'Unknown image_url, send image_data instead'
+    return row[0], path, None
+
+def try_gemini_vision(image, product_name, category_names):
+    """Describe a product from its prepared JPEG (see prepare_gemini_image) with Gemini Vision"""
+    try:
+        # Create a simple but effective prompt
+        prompt = GEMINI_DESCRIPTION_PROMPT.format(product_name=product_name, categories_text=', '.join(category_names))
+
+        # Generate content with the shared client's resolved model
+        return gemini_client.generate([prompt, {'mime_type': 'image/jpeg', 'data': image}])
             
     except Exception as e:
         print(f"Gemini Vision error: {str(e)}")
@@ -1196,141 +4054,86 @@ Description:"""
 @app.route('/api/test-gemini', methods=['GET'])
 @app.route('/api/test', methods=['GET'])  # Alternative URL
 def test_gemini_api():
-    """Test if Gemini API is configured correctly"""
-    print("\n=== Starting Gemini API Test ===")
-    try:
-        # Check if API key is configured
-        if not GEMINI_API_KEY or GEMINI_API_KEY == 'your_gemini_api_key_here':
-            print("Error: Gemini API key not configured")
-            return jsonify({
-                'status': 'error',
-                'message': 'Gemini API key not configured',
-                'key_status': 'missing or default',
-                'key_value': 'not set or default value'
-            }), 400
-            
-        print(f"API Key configured (first 10 chars): {GEMINI_API_KEY[:10]}...")
-            
-        # Configure Gemini
-        print("Configuring Gemini API...")
-        genai.configure(api_key=GEMINI_API_KEY)
-        print("Gemini API configured")
-        
-        # Try current model names
-        model = None
-        error_messages = []
-        model_names = [
-            'gemini-1.5-flash',
-            'gemini-1.5-pro',
-            'models/gemini-1.5-flash', 
-            'models/gemini-1.5-pro'
-        ]
-        
-        print("Attempting to initialize model...")
-        for model_name in model_names:
-            try:
-                print(f"Trying '{model_name}'...")
-                model = genai.GenerativeModel(model_name)
-                print(f"Successfully initialized '{model_name}'")
-                break
-            except Exception as e:
-                error_messages.append(f"Error with {model_name}: {str(e)}")
-                print(f"Error with {model_name}: {str(e)}")
-                continue
-        
-        if not model:
-            print("Error: No model was successfully initialized")
-            return jsonify({
-                'status': 'error',
-                'message': 'Failed to initialize any Gemini model',
-                'error_details': error_messages
-            }), 500
-        
-        # Try a simple prompt
-        print("Sending test prompt...")
-        response = model.generate_content("Hello! Can you confirm that you're working properly?")
-        print("Received response from model")
-        
-        if not response or not response.text:
-            print("Error: Empty response from model")
-            return jsonify({
-                'status': 'error',
-                'message': 'Model returned empty response',
-                'error_details': 'No text in response'
-            }), 500
-        
-        print("Test completed successfully")
+    """Report the Gemini client's configuration and resolved model from its cached state"""
+    if not gemini_client.is_configured():
         return jsonify({
-            'status': 'success',
-            'message': 'Gemini API is working correctly',
-            'response': response.text,
-            'key_status': 'configured',
-            'model_used': model.model_name
-        })
-        
+            'status': 'error',
+            'message': 'Gemini API key not configured',
+            'key_status': 'missing or default',
+            'gemini': gemini_client.status()
+        }), 400
+
+    try:
+        # Only resolves when nothing is cached yet or the TTL has run out
+        model_name = gemini_client.resolve_model()
     except Exception as e:
-        print(f"Gemini API test error: {str(e)}")
-        import traceback
-        traceback.print_exc()
         return jsonify({
             'status': 'error',
             'message': f'Gemini API test failed: {str(e)}',
-            'key_status': 'error',
-            'error_details': traceback.format_exc()
+            'key_status': 'configured',
+            'gemini': gemini_client.status()
         }), 500
 
+    return jsonify({
+        'status': 'success',
+        'message': 'Gemini API is working correctly',
+        'key_status': 'configured',
+        'model_used': model_name,
+        'gemini': gemini_client.status()
+    })
+
 # Add a simple health check endpoint
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    """Simple health check endpoint"""
+    """Health check endpoint; in eager mode it returns 503 until CLIP is warmed up"""
+    clip = clip_status()
+    if CLIP_LOAD_MODE == 'eager' and clip['state'] != 'ready':
+        return jsonify({
+            'status': clip['state'],
+            'message': 'CLIP model is not ready yet',
+            'clip': clip
+        }), 503
     return jsonify({
         'status': 'ok',
-        'message': 'Server is running'
+        'message': 'Server is running',
+        'clip': clip,
+        # An open circuit only means descriptions use the template fallback for now
+        'gemini': gemini_client.status()
     })
 
 @app.route('/api/list-gemini-models', methods=['GET'])
 def list_gemini_models():
-    """List available Gemini models"""
-    try:
-        if not GEMINI_API_KEY or GEMINI_API_KEY == 'your_gemini_api_key_here':
-            return jsonify({
-                'status': 'error',
-                'message': 'Gemini API key not configured',
-                'key_status': 'missing or default'
-            }), 400
-            
-        # Configure Gemini
-        genai.configure(api_key=GEMINI_API_KEY)
-        
-        # List available models
-        models = genai.list_models()
-        available_models = []
-        
-        for model in models:
-            model_info = {
-                'name': model.name,
-                'display_name': model.display_name,
-                'description': model.description,
-                'supported_generation_methods': [
-                    method for method in model.supported_generation_methods
-                ]
-            }
-            available_models.append(model_info)
-        
+    """List the Gemini models seen when the client last resolved its model"""
+    if not gemini_client.is_configured():
         return jsonify({
-            'status': 'success',
-            'models': available_models
-        })
-        
+            'status': 'error',
+            'message': 'Gemini API key not configured',
+            'key_status': 'missing or default'
+        }), 400
+
+    try:
+        models = gemini_client.available_models()
     except Exception as e:
         print(f"Error listing Gemini models: {str(e)}")
-        import traceback
-        traceback.print_exc()
         return jsonify({
             'status': 'error',
             'message': f'Failed to list Gemini models: {str(e)}',
-            'error_details': traceback.format_exc()
+            'gemini': gemini_client.status()
         }), 500
 
+    return jsonify({
+        'status': 'success',
+        'models': models,
+        'model_used': gemini_client.status()['model']
+    })
+
+# Start loading CLIP in the background instead of on the first request
+if CLIP_LOAD_MODE == 'eager':
+    start_clip_warmup()
+
 if __name__ == '__main__':
+    # Create resized variants for images uploaded before they existed. Only the dev server
+    # does this (in the reloader's child process); other deployments run backfill_image_variants.py
+    if IMAGE_VARIANT_BACKFILL and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_image_variant_backfill()
     app.run(debug=True, host='0.0.0.0', port=8000) 
\ No newline at end of file
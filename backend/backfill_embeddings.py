@@ -0,0 +1,60 @@
+import argparse
+import os
+
+import app
+
+
+def products_missing_embeddings(conn):
+    """Return (product_id, image path) for uploaded products without a current embedding."""
+    c = conn.cursor()
+    c.execute('''
+        SELECT p.id, p.image_url
+        FROM products p
+        LEFT JOIN product_embeddings e ON e.product_id = p.id
+        WHERE p.image_url LIKE '/uploads/%'
+          AND (e.product_id IS NULL OR e.model_version != ?)
+        ORDER BY p.created_at
+    ''', (app.image_embedding_version(),))
+    return [
+        (product_id, os.path.join(app.app.config['UPLOAD_FOLDER'], image_url[len('/uploads/'):]))
+        for product_id, image_url in c.fetchall()
+    ]
+
+
+def backfill_embeddings(batch_size=32):
+    """Embed existing uploads in batches and store them in product_embeddings."""
+    conn = app.connect_db()
+    pending = products_missing_embeddings(conn)
+    print(f"{len(pending)} products need an embedding")
+
+    stored = 0
+    skipped = 0
+    for start in range(0, len(pending), batch_size):
+        batch = []
+        for product_id, image_path in pending[start:start + batch_size]:
+            try:
+                with open(image_path, 'rb') as f:
+                    batch.append((product_id, app.decode_image(f)))
+            except Exception as e:
+                print(f"  Skipping {product_id} ({image_path}): {str(e)}")
+                skipped += 1
+
+        if not batch:
+            continue
+        embeddings = app.encode_images([image for _, image in batch])
+        c = conn.cursor()
+        for (product_id, _), embedding in zip(batch, embeddings):
+            app.save_product_embedding(c, product_id, embedding)
+        conn.commit()
+        stored += len(batch)
+        print(f"  Stored {stored}/{len(pending)} embeddings")
+
+    conn.close()
+    print(f"Backfill completed: {stored} stored, {skipped} skipped")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute CLIP embeddings for products uploaded before embeddings were stored.')
+    parser.add_argument('--batch-size', type=int, default=32, help='Images per CLIP forward pass')
+    args = parser.parse_args()
+    backfill_embeddings(args.batch_size)
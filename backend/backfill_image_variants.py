@@ -0,0 +1,7 @@
+import app
+
+
+if __name__ == '__main__':
+    # Run once after deploying (or after changing IMAGE_VARIANT_WIDTHS for new uploads);
+    # products whose image could not be read are marked so they are not retried
+    app.backfill_image_variants()
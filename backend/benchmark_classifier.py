@@ -0,0 +1,97 @@
+import argparse
+import os
+import statistics
+import time
+
+from PIL import Image
+
+import app
+
+
+def load_images(image_dir, limit):
+    """Load up to `limit` images from a directory as RGB PIL images."""
+    images = []
+    for filename in sorted(os.listdir(image_dir)):
+        if not app.allowed_file(filename):
+            continue
+        try:
+            images.append(Image.open(os.path.join(image_dir, filename)).convert('RGB'))
+        except Exception as e:
+            print(f"Skipping {filename}: {str(e)}")
+        if len(images) >= limit:
+            break
+    return images
+
+
+def top_label(scores):
+    return max(scores.items(), key=lambda x: x[1])[0]
+
+
+def time_per_image(images, classify):
+    """Run `classify` on each image separately and return (latencies in ms, top-1 labels)."""
+    latencies = []
+    labels = []
+    for image in images:
+        start = time.perf_counter()
+        labels.append(classify(image))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, labels
+
+
+def benchmark_classifier(image_dir, limit=50):
+    """Compare flat leaf scoring against the hierarchical classifier on a local image set."""
+    images = load_images(image_dir, limit)
+    if not images:
+        print(f"No images found in {image_dir}")
+        return
+
+    app.load_clip()
+    leaf_bank = app.get_prompt_bank('leaf')
+    app.get_prompt_bank('main')
+
+    def flat_uncached(image):
+        # What scoring every leaf prompt costs without a prompt bank
+        features = app.encode_images([image])
+        text_features = app.encode_text_prompts(leaf_bank['prompts'])
+        similarity = (features @ text_features.T)[0]
+        scores = {}
+        for label, score in zip(leaf_bank['labels'], similarity.tolist()):
+            scores.setdefault(label, []).append(score)
+        return top_label({label: sum(values) / len(values) for label, values in scores.items()})
+
+    def flat_bank(image):
+        return top_label(app.score_image_features(app.encode_images([image]), 'leaf')[0])
+
+    def hierarchical(image):
+        return top_label(app.score_image_features(app.encode_images([image]), 'hierarchical')[0])
+
+    # One warm-up pass so the first measured image does not pay for allocator setup
+    app.encode_images(images[:1])
+
+    runs = [
+        ('flat, text encoded per image', flat_uncached),
+        ('flat, prompt bank', flat_bank),
+        (f'hierarchical (top-{app.HIERARCHICAL_TOP_K})', hierarchical),
+    ]
+
+    print(f"\n{len(images)} images, {len(leaf_bank['prompts'])} leaf prompts, {len(leaf_bank['categories'])} leaf categories\n")
+    print(f"{'mode':<32} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    labels_by_mode = {}
+    for name, classify in runs:
+        latencies, labels = time_per_image(images, classify)
+        labels_by_mode[name] = labels
+        p95 = sorted(latencies)[max(0, int(len(latencies) * 0.95) - 1)]
+        print(f"{name:<32} {statistics.mean(latencies):>9.1f} {statistics.median(latencies):>9.1f} {p95:>9.1f}")
+
+    flat_labels = labels_by_mode['flat, prompt bank']
+    hierarchical_labels = labels_by_mode[runs[-1][0]]
+    agreement = sum(a == b for a, b in zip(flat_labels, hierarchical_labels)) / len(images)
+    print(f"\nTop-1 leaf agreement, hierarchical vs flat: {agreement:.1%}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark flat vs hierarchical CLIP categorization.')
+    parser.add_argument('image_dir', help='Directory with sample product images')
+    parser.add_argument('--limit', type=int, default=50, help='Maximum number of images to use')
+    args = parser.parse_args()
+    benchmark_classifier(args.image_dir, args.limit)
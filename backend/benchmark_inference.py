@@ -0,0 +1,76 @@
+import argparse
+import copy
+import statistics
+import time
+
+import torch
+from transformers import CLIPModel
+
+import app
+from benchmark_classifier import load_images
+
+
+def main_category_matrix(model):
+    """Build the main-category embedding matrix for a given model, like the 'main' prompt bank."""
+    prompts, labels = app.build_main_category_prompts()
+    embeddings = app.encode_text_prompts(prompts, model=model)
+    categories = list(dict.fromkeys(labels))
+    matrix = torch.stack([
+        embeddings[[i for i, label in enumerate(labels) if label == category]].mean(dim=0)
+        for category in categories
+    ])
+    return categories, matrix
+
+
+def measure(model, images, batch_size):
+    """Return (per-image latencies in ms, images/sec at batch_size, top-1 main category per image)."""
+    categories, matrix = main_category_matrix(model)
+    app.encode_images(images[:1], model=model)  # warm-up
+
+    latencies = []
+    top1 = []
+    for image in images:
+        start = time.perf_counter()
+        features = app.encode_images([image], model=model)
+        latencies.append((time.perf_counter() - start) * 1000)
+        top1.append(categories[int((features @ matrix.T).argmax())])
+
+    start = time.perf_counter()
+    for i in range(0, len(images), batch_size):
+        app.encode_images(images[i:i + batch_size], model=model)
+    throughput = len(images) / (time.perf_counter() - start)
+    return latencies, throughput, top1
+
+
+def benchmark_inference(image_dir, limit=50, batch_size=16, quantize='int8'):
+    """Compare the configured CPU inference profile against the fp32 baseline."""
+    images = load_images(image_dir, limit)
+    if not images:
+        print(f"No images found in {image_dir}")
+        return
+
+    if app.CLIP_NUM_THREADS > 0:
+        torch.set_num_threads(app.CLIP_NUM_THREADS)
+    baseline = CLIPModel.from_pretrained(app.CLIP_MODEL_NAME).eval()
+    profiled = app.apply_inference_profile(copy.deepcopy(baseline), quantize)
+
+    print(f"\n{len(images)} images, batch size {batch_size}, {torch.get_num_threads()} torch threads\n")
+    print(f"{'profile':<12} {'mean ms':>9} {'p50 ms':>9} {'img/s':>9}")
+    results = {}
+    for name, model in [('fp32', baseline), (quantize, profiled)]:
+        latencies, throughput, top1 = measure(model, images, batch_size)
+        results[name] = top1
+        print(f"{name:<12} {statistics.mean(latencies):>9.1f} {statistics.median(latencies):>9.1f} {throughput:>9.1f}")
+
+    agreement = sum(a == b for a, b in zip(results['fp32'], results[quantize])) / len(images)
+    print(f"\nTop-1 main category agreement with fp32: {agreement:.1%}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the CLIP CPU inference profile against fp32.')
+    parser.add_argument('image_dir', help='Directory with sample product images')
+    parser.add_argument('--limit', type=int, default=50, help='Maximum number of images to use')
+    parser.add_argument('--batch-size', type=int, default=16, help='Batch size for the throughput run')
+    parser.add_argument('--quantize', default='int8', choices=['none', 'int8'], help='Profile to compare against fp32')
+    args = parser.parse_args()
+    benchmark_inference(args.image_dir, args.limit, args.batch_size, args.quantize)
@@ -0,0 +1,23 @@
+import sys
+
+import app
+
+
+def check_query_plans():
+    """Print the query plan of each hot product query; exits non-zero if one needs a full scan or temp sort."""
+    conn = app.connect_db()
+    print(f"Schema version: {app.schema_version(conn)}\n")
+    failed = 0
+    for name, plan, ok in app.check_query_plans(conn):
+        print(f"{'OK  ' if ok else 'FAIL'} {name}")
+        for detail in plan:
+            print(f"       {detail}")
+        failed += not ok
+    conn.close()
+    if failed:
+        print(f"\n{failed} queries need a full scan or temp B-tree sort")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    check_query_plans()
@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+from PIL import Image
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_workload(mode, database, threads, requests_per_thread, upload_every):
+    """Run the mixed catalog/upload workload in this process and print a JSON summary."""
+    scratch = tempfile.mkdtemp()
+    os.environ['DATABASE_PATH'] = os.path.join(scratch, 'bootstrap.db')
+    import app
+    import torch
+
+    # Point the app at the copied database; the baseline uses plain connections like before pooling
+    app.DATABASE = database
+    if mode == 'baseline':
+        # journal_mode is stored in the file, so a products.db the app has opened is still WAL
+        conn = sqlite3.connect(database)
+        conn.execute('PRAGMA journal_mode = DELETE')
+        conn.close()
+        app.SQLITE_PRAGMAS = ('PRAGMA synchronous = FULL',)
+        app.DB_POOL_SIZE = 0
+    app.init_db()
+    app.app.config['UPLOAD_FOLDER'] = scratch
+
+    # Prime the categorization cache so uploads measure the database path, not CLIP
+    buffer = BytesIO()
+    Image.new('RGB', (64, 64), color=(200, 30, 30)).save(buffer, format='JPEG')
+    image_bytes = buffer.getvalue()
+    app.cache_categorization(app.categorization_cache_key(image_bytes), [], torch.zeros(512))
+
+    client = app.app.test_client()
+    client.post('/api/register', json={'email': 'loadtest@example.com', 'password': 'loadtest', 'role': 'seller'})
+    token = client.post('/api/login', json={'email': 'loadtest@example.com', 'password': 'loadtest'}).json['token']
+    headers = {'Authorization': f'Bearer {token}'}
+
+    latencies = {'all-products': [], 'upload': []}
+    errors = {'all-products': 0, 'upload': 0}
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        worker_client = app.app.test_client()
+        for i in range(requests_per_thread):
+            start = time.perf_counter()
+            if upload_every and i % upload_every == 0:
+                name = 'upload'
+                response = worker_client.post('/api/upload', headers=headers, content_type='multipart/form-data', data={
+                    'file': (BytesIO(image_bytes), f'load_{worker_id}_{i}.jpg'),
+                    'name': f'Load test {worker_id}-{i}',
+                    'description': 'Load test product',
+                    'price': '9.99',
+                    'categories': json.dumps([{'name': 'Electronics', 'confidence': 0.5}])
+                })
+            else:
+                name = 'all-products'
+                response = worker_client.get('/api/all-products')
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies[name].append(elapsed)
+                if response.status_code != 200:
+                    errors[name] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    duration = time.perf_counter() - started
+
+    summary = {'mode': mode, 'duration': duration}
+    for name, values in latencies.items():
+        summary[name] = {
+            'count': len(values),
+            'errors': errors[name],
+            'p50_ms': statistics.median(values) if values else 0.0,
+            'p95_ms': percentile(values, 0.95) if values else 0.0,
+        }
+    summary['throughput'] = sum(len(values) for values in latencies.values()) / duration
+    print(json.dumps(summary))
+    shutil.rmtree(scratch, ignore_errors=True)
+
+
+def load_test(threads, requests_per_thread, upload_every):
+    """Run the workload against a copy of products.db, before and after connection tuning."""
+    print(f"{threads} threads x {requests_per_thread} requests, one upload every {upload_every} requests\n")
+    print(f"{'mode':<10} {'req/s':>8} {'list p50':>9} {'list p95':>9} {'upload p50':>11} {'upload p95':>11} {'errors':>7}")
+    for mode in ('baseline', 'tuned'):
+        workdir = tempfile.mkdtemp()
+        database = os.path.join(workdir, 'products.db')
+        shutil.copy('products.db', database)
+        output = subprocess.run(
+            [sys.executable, __file__, '--run-mode', mode, '--database', database,
+             '--threads', str(threads), '--requests', str(requests_per_thread), '--upload-every', str(upload_every)],
+            capture_output=True, text=True
+        )
+        shutil.rmtree(workdir, ignore_errors=True)
+        lines = [line for line in output.stdout.splitlines() if line.startswith('{')]
+        if output.returncode != 0 or not lines:
+            print(f"{mode:<10} failed:\n{output.stderr[-2000:]}")
+            continue
+        result = json.loads(lines[-1])
+        listing = result['all-products']
+        upload = result['upload']
+        print(f"{mode:<10} {result['throughput']:>8.1f} {listing['p50_ms']:>9.1f} {listing['p95_ms']:>9.1f} "
+              f"{upload['p50_ms']:>11.1f} {upload['p95_ms']:>11.1f} {listing['errors'] + upload['errors']:>7}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test /api/all-products and /api/upload with and without SQLite tuning.')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=100, help='Requests per thread')
+    parser.add_argument('--upload-every', type=int, default=5, help='Every Nth request of a thread is an upload')
+    parser.add_argument('--run-mode', choices=['baseline', 'tuned'], help=argparse.SUPPRESS)
+    parser.add_argument('--database', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_mode:
+        run_workload(args.run_mode, args.database, args.threads, args.requests, args.upload_every)
+    else:
+        load_test(args.threads, args.requests, args.upload_every)
@@ -56,7 +56,8 @@ import {
     FaCheck,
     FaStar,
     FaLightbulb,
-    FaGem
+    FaGem,
+    FaSyncAlt
 } from 'react-icons/fa';
 import { CloseIcon } from '@chakra-ui/icons';
 import axios from 'axios';
@@ -74,6 +75,7 @@ const SellerDashboard = () => {
     const [loading, setLoading] = useState(false);
     const [aiLoading, setAiLoading] = useState(false);
     const [descriptionLoading, setDescriptionLoading] = useState(false);
+    const descriptionImageRef = useRef({ file: null, hash: null });
     const [step, setStep] = useState(1); // 1: Upload, 2: AI Analysis, 3: Details, 4: Final
 
     // Camera related states
@@ -301,8 +303,8 @@ const SellerDashboard = () => {
         }
     };
 
-    // Generate AI description function
-    const handleGenerateDescription = async () => {
+    // Generate AI description function; regenerate asks for new text even when the inputs are unchanged
+    const handleGenerateDescription = async (regenerate = false) => {
         if (selectedCategories.length === 0) {
             toast({
                 title: 'Select Categories First',
@@ -332,24 +334,61 @@ const SellerDashboard = () => {
                 categories: selectedCategories.map(cat => ({ name: cat })),
                 product_name: name.trim()
             };
+            // Without it the server answers identical inputs from its description cache
+            if (regenerate) {
+                requestData.regenerate = true;
+            }
 
-            // If we have an image, send it for vision analysis
-            if (image) {
-                // Convert image to base64 for vision models
-                const reader = new FileReader();
-                const imageDataPromise = new Promise((resolve) => {
-                    reader.onload = () => resolve(reader.result);
-                    reader.readAsDataURL(image);
-                });
+            // Generation runs as a background job; poll it until it finishes
+            const token = localStorage.getItem('token');
+            const headers = token ? { 'Authorization': `Bearer ${token}` } : {};
+            const jobsUrl = 'http://localhost:8000/api/generate-description/jobs';
+            let submitted = null;
+
+            // The server keeps the image after the first request, so repeat requests only send its hash
+            if (image && descriptionImageRef.current.file === image) {
+                try {
+                    submitted = await axios.post(jobsUrl, { ...requestData, image_hash: descriptionImageRef.current.hash }, { headers });
+                } catch (error) {
+                    if (!error.response || error.response.status !== 400) {
+                        throw error;
+                    }
+                    // The server no longer knows the hash; fall back to sending the image
+                }
+            }
 
-                const imageData = await imageDataPromise;
-                requestData.image_data = imageData;
+            if (!submitted) {
+                // If we have an image, send it for vision analysis
+                if (image) {
+                    // Convert image to base64 for vision models
+                    const reader = new FileReader();
+                    const imageDataPromise = new Promise((resolve) => {
+                        reader.onload = () => resolve(reader.result);
+                        reader.readAsDataURL(image);
+                    });
+
+                    const imageData = await imageDataPromise;
+                    requestData.image_data = imageData;
+                }
+                submitted = await axios.post(jobsUrl, requestData, { headers });
             }
 
-            const response = await axios.post('http://localhost:8000/api/generate-description', requestData);
+            let job = submitted.data;
+            while (job.status === 'queued' || job.status === 'running') {
+                await new Promise((resolve) => setTimeout(resolve, 1000));
+                const poll = await axios.get(`http://localhost:8000${submitted.data.status_url}`);
+                job = poll.data;
+            }
+            if (job.status !== 'done') {
+                throw new Error(job.error || 'Description job failed');
+            }
 
-            if (response.data.description) {
-                setDescription(response.data.description);
+            if (image && job.result.image_hash) {
+                descriptionImageRef.current = { file: image, hash: job.result.image_hash };
+            }
+
+            if (job.result.description) {
+                setDescription(job.result.description);
                 toast({
                     title: 'Description Generated!',
                     description: 'AI has analyzed your product image and generated a professional description.',
@@ -640,13 +679,25 @@ const SellerDashboard = () => {
                                                         size="sm"
                                                         colorScheme="green"
                                                         leftIcon={<Icon as={FaMagic} />}
-                                                        onClick={handleGenerateDescription}
+                                                        onClick={() => handleGenerateDescription(false)}
                                                         isLoading={descriptionLoading}
                                                         loadingText="Generating..."
                                                         isDisabled={selectedCategories.length === 0 || !name || name.trim() === ''}
                                                     >
                                                         Generate AI Description
                                                     </Button>
+                                                    {description && (
+                                                        <Button
+                                                            size="sm"
+                                                            variant="outline"
+                                                            colorScheme="green"
+                                                            leftIcon={<Icon as={FaSyncAlt} />}
+                                                            onClick={() => handleGenerateDescription(true)}
+                                                            isDisabled={descriptionLoading || selectedCategories.length === 0 || !name || name.trim() === ''}
+                                                        >
+                                                            New Text
+                                                        </Button>
+                                                    )}
                                                     <Text fontSize="sm" color="gray.500">
                                                         {selectedCategories.length === 0 && (!name || name.trim() === '') ?
                                                             'Enter product name and select categories first' :